@@ -0,0 +1,179 @@
+""" Times and memory-profiles the forward and inverse hot paths over a matrix of problem sizes
+
+Every configuration runs in a fresh spawned process, so peak memory and operator setup are measured in isolation.
+Results are written as JSON, see benchmarks/compare.py to compare two runs.
+
+    python benchmarks/benchmark.py --output benchmarks/results/current.json
+    python benchmarks/benchmark.py --quick
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import subprocess
+import tracemalloc
+import multiprocessing
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MATRIX = {
+    "forward_grids": [100, 200],
+    "inverse_grids": [25, 50],
+    "sensor_count": [20, 40],
+    "fill_fraction": [0.02, 0.1]
+}
+
+QUICK_MATRIX = {
+    "forward_grids": [100],
+    "inverse_grids": [25],
+    "sensor_count": [20],
+    "fill_fraction": [0.02]
+}
+
+
+def measure(function, repeat):
+    """ Best wall time over repeat calls and peak traced allocation of the first call """
+    tracemalloc.start()
+    output = function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return output, {"seconds": min(timings), "peak_bytes": peak}
+
+
+def configure(forward_grids, inverse_grids, sensor_count):
+    from config import Configuration
+
+    # Stages are timed on the computation itself, not on loading cached operators
+    return Configuration.from_config().replace(doi={"forward_grids": forward_grids, "inverse_grids": inverse_grids},
+                                               sensors={"count": sensor_count}, cache={"enabled": False})
+
+
+def forward_case(forward_grids, sensor_count, fill_fraction, repeat):
+    config = configure(forward_grids, 50, sensor_count)
+    from scatterer.scatterer import Scatterer
+    from forward_problem.model import MethodOfMomentModel
+
+    size = np.sqrt(fill_fraction) * config.doi["length"] / 2
+    scatterer = Scatterer("forward", None, [{"shape": "square", "center_x": 0, "center_y": 0, "size": size,
+                                             "permittivity": 3 + 0.3j}], config).generate()
+    model = MethodOfMomentModel(scatterer, config=config)
+    model.find_grids_with_object()
+
+    results = {}
+    _, results["incident_field"] = measure(model.get_incident_field, repeat)
+    Z, results["z_assembly"] = measure(model.get_field_from_scattering, repeat)
+    current, results["current_solve"] = measure(lambda: model.get_induced_current(Z), repeat)
+    _, results["scattered_field"] = measure(lambda: model.get_scattered_field(current), repeat)
+    for stage in results:
+        results[stage]["object_grids"] = len(model.object_grid_indices)
+    return results
+
+
+def inverse_case(inverse_grids, sensor_count, repeat):
+    config = configure(200, inverse_grids, sensor_count)
+    from inverse_problem.inverse import LinearInverse
+    from inverse_problem.models import PRytov, PRytovComplex, PRytovImag
+    from inverse_problem.regularize import Regularizer
+
+    inverse_problem = LinearInverse(config=config)
+    direct_field = inverse_problem.get_direct_field()
+    incident_field = inverse_problem.get_incident_field()
+    integral_values = inverse_problem.get_greens_integral()
+
+    results = {}
+    models = {}
+    for name, model_class in [("prytov", PRytov), ("prytov_complex", PRytovComplex), ("prytov_imag", PRytovImag)]:
+        models[name], results[f"model_{name}"] = measure(
+            lambda: model_class(config).get_model(direct_field, incident_field, integral_values), repeat)
+
+    A = models["prytov_complex"]
+    data = np.random.default_rng(0).standard_normal(A.shape[0]) * 0.1
+    priors = {
+        "ridge": (Regularizer.ridge, {"alpha": 15}),
+        "qs2D": (Regularizer.quadratic_smoothing, {"alpha": 15, "sparse": True}),
+        "lasso": (Regularizer.lasso, {"alpha": 1e-3, "positive": False}),
+        "elasticnet": (Regularizer.elasticnet, {"alpha": 1e-3, "l1_ratio": 0.5, "positive": False})
+    }
+    for name, (prior, params) in priors.items():
+        _, results[f"prior_{name}"] = measure(lambda: prior(A, data, params), repeat)
+    return results
+
+
+def run_case(case):
+    """ Entry point of the spawned process """
+    import warnings
+    warnings.simplefilter("ignore")
+    group, parameters, repeat = case
+    if group == "forward":
+        return forward_case(parameters["forward_grids"], parameters["sensor_count"], parameters["fill_fraction"], repeat)
+    return inverse_case(parameters["inverse_grids"], parameters["sensor_count"], repeat)
+
+
+def get_cases(matrix, repeat):
+    cases = []
+    for forward_grids, sensor_count, fill_fraction in itertools.product(
+            matrix["forward_grids"], matrix["sensor_count"], matrix["fill_fraction"]):
+        cases.append(("forward", {"forward_grids": forward_grids, "sensor_count": sensor_count,
+                                  "fill_fraction": fill_fraction}, repeat))
+    for inverse_grids, sensor_count in itertools.product(matrix["inverse_grids"], matrix["sensor_count"]):
+        cases.append(("inverse", {"inverse_grids": inverse_grids, "sensor_count": sensor_count}, repeat))
+    return cases
+
+
+def get_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the forward and inverse solver stages")
+    parser.add_argument("--output", default=None, help="JSON file for the results, default benchmarks/results/<revision>.json")
+    parser.add_argument("--repeat", type=int, default=3, help="timed repetitions of every stage, the best one is kept")
+    parser.add_argument("--quick", action="store_true", help="run only the smallest configuration")
+    args = parser.parse_args()
+
+    revision = get_revision()
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", f"{revision}.json")
+    cases = get_cases(QUICK_MATRIX if args.quick else MATRIX, args.repeat)
+
+    records = []
+    context = multiprocessing.get_context("spawn")
+    for case in cases:
+        group, parameters, _ = case
+        with context.Pool(1) as pool:
+            results = pool.apply(run_case, (case,))
+        for stage, result in results.items():
+            records.append({"group": group, "stage": stage, **parameters, **result})
+            print(f"{group:8s} {stage:22s} {json.dumps(parameters):80s} {result['seconds']:10.4f} s "
+                  f"{result['peak_bytes'] / 2 ** 20:10.1f} MiB")
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump({
+            "revision": revision,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "machine": {"platform": platform.platform(), "processor": platform.processor(),
+                        "python": platform.python_version(), "numpy": np.__version__},
+            "repeat": args.repeat,
+            "results": records
+        }, file, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+""" Compares two benchmark result files written by benchmarks/benchmark.py
+
+    python benchmarks/compare.py benchmarks/results/old.json benchmarks/results/new.json --threshold 1.2
+"""
+import sys
+import json
+import argparse
+
+KEYS = ("group", "stage", "forward_grids", "inverse_grids", "sensor_count", "fill_fraction")
+
+
+def load(path):
+    with open(path) as file:
+        results = json.load(file)
+    return results["revision"], {tuple(record.get(key) for key in KEYS): record for record in results["results"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark runs")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="time ratio (candidate / baseline) above which a stage is reported as a regression")
+    args = parser.parse_args()
+
+    baseline_revision, baseline = load(args.baseline)
+    candidate_revision, candidate = load(args.candidate)
+
+    print(f"{'stage':60s} {baseline_revision:>12s} {candidate_revision:>12s} {'ratio':>8s} {'memory':>8s}")
+    regressions = 0
+    for key in sorted(set(baseline) & set(candidate), key=str):
+        old, new = baseline[key], candidate[key]
+        ratio = new["seconds"] / old["seconds"] if old["seconds"] > 0 else float("inf")
+        memory_ratio = new["peak_bytes"] / old["peak_bytes"] if old["peak_bytes"] > 0 else float("inf")
+        label = " ".join(str(value) for value in key if value is not None)
+        flag = " REGRESSION" if ratio > args.threshold else ""
+        regressions += bool(flag)
+        print(f"{label:60s} {old['seconds']:12.4f} {new['seconds']:12.4f} {ratio:8.2f} {memory_ratio:8.2f}{flag}")
+
+    print(f"{regressions} regression(s) above {args.threshold}x")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+""" Times the import of the package modules in fresh interpreters and lists the heavy dependencies each one loads
+
+Every import runs in a new process, the best of --repeat runs is reported. Importing a solver should not load
+sklearn or matplotlib, which only the code paths using them import.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --output benchmarks/results/import_time.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    "config",
+    "scatterer.scatterer",
+    "forward_problem.model",
+    "forward_problem.solve",
+    "forward_problem.dataset",
+    "inverse_problem.regularize",
+    "inverse_problem.solve",
+    "inverse_problem.nonlinear",
+    "cli"
+]
+HEAVY_MODULES = ["sklearn", "matplotlib", "scipy.stats", "scipy.ndimage"]
+
+SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {heavy} if name in sys.modules]}}))
+"""
+
+
+def time_import(module, repeat):
+    """ Best import time of module over repeat fresh interpreters, with the heavy modules it loaded """
+    best = None
+    for _ in range(repeat):
+        # The interpreter start itself is not timed, only the import statement
+        output = subprocess.run([sys.executable, "-c", SCRIPT.format(module=module, heavy=HEAVY_MODULES)], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the import of the package modules")
+    parser.add_argument("--output", default=None, help="JSON file for the results, printed only if not given")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per module, the best one is kept")
+    parser.add_argument("--modules", nargs="+", default=MODULES, help="modules to import")
+    args = parser.parse_args()
+
+    records = []
+    for module in args.modules:
+        result = time_import(module, args.repeat)
+        records.append({"module": module, **result})
+        print(f"{module:30s} {result['seconds']:8.3f} s  {', '.join(result['loaded'])}")
+
+    if args.output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump({
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": sys.version.split()[0],
+                "repeat": args.repeat,
+                "results": records
+            }, file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+""" Headless runner for forward, inverse and combined jobs described in a JSON or YAML spec
+
+    python cli.py jobs.json --workers 4
+    python cli.py jobs.yaml --render --output data/runs
+    python cli.py sweep.json --threads --workers 4
+
+A spec is a list of jobs, or an object with the jobs and optionally defaults merged into every job:
+
+    {
+        "output": "data/runs",
+        "defaults": {"model_name": "prytov_imag", "prior": "qs2D", "params": {"alpha": 15, "sparse": true}},
+        "jobs": [
+            {"name": "two_circles", "type": "combined", "scatterers": [
+                {"shape": "circle", "center_x": -0.3, "center_y": 0.35, "size": 0.15, "permittivity": [4, 0.4]},
+                {"shape": "circle", "center_x": 0.3, "center_y": 0.35, "size": 0.15, "permittivity": "4+0.4j"}]},
+            {"name": "two_circles_ridge", "type": "inverse", "input": "data/runs/two_circles", "prior": "ridge",
+             "params": {"alpha": 10}}
+        ]
+    }
+
+Job keys:
+    name            - name of the job and of its dataset store <output>/<name>, job_<number> if missing
+    type            - "forward", "inverse" or "combined" (forward followed by inverse on its data)
+    scatterers      - scatterer_params as accepted by Scatterer, permittivity as a number, [real, imag] or "a+bj"
+    engine          - forward engine and engine_params, see ForwardProblemSolver
+    frequencies     - list of frequencies of a wideband job, its data has a last frequency axis and is reconstructed
+                      jointly; inverse jobs read them from their input store if not given
+    inverse_type    - inverse_type of the inverse scatterer stored next to the reconstruction
+    model_name      - Rytov model, prior and params, see InverseProblemSolver
+    method          - "linear" (default), "multiresolution" or "distorted_born", with method_params the keyword
+                      arguments of InverseProblemSolver.solve_multiresolution or DistortedBornSolver
+    input, sample   - dataset store and sample number the measurements of an inverse job are read from
+    render          - whether figures are saved to <output>/<name>/figures, the fields of transmitter render_tx
+    profile         - per-stage timing and memory of the solvers, see utils/profile_utils.py
+    config          - changes to the sections of Config for this job, e.g. {"doi": {"inverse_grids": 25}}
+    sweep           - lists of values of config entries, e.g. {"system": {"frequency": [2.4e9, 5e9]}}; the job is
+                      expanded into one job per combination, named <name>_<number>
+
+Every job writes its data and reconstruction as one sample of a new dataset store, see utils/store_utils.py.
+Jobs run on worker processes, or with --threads on threads of this process, which share operators in memory.
+matplotlib is only imported, with the non-interactive Agg backend, by jobs that render figures.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from config import Configuration
+from scatterer.scatterer import Scatterer
+from forward_problem.solve import ForwardProblemSolver
+from inverse_problem.solve import InverseProblemSolver
+from utils.store_utils import DatasetStore
+
+JOB_TYPES = ("forward", "inverse", "combined")
+METHODS = ("linear", "multiresolution", "distorted_born")
+
+# pyplot keeps global state, jobs running on threads render one at a time
+RENDER_LOCK = threading.Lock()
+
+
+def load_spec(path):
+    """ Jobs of the spec file at path, with the defaults merged in, and the output directory of the spec """
+    with open(path) as file:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("YAML specs need the pyyaml package, install it or use a JSON spec")
+            spec = yaml.safe_load(file)
+        else:
+            spec = json.load(file)
+
+    if isinstance(spec, list):
+        spec = {"jobs": spec}
+    defaults = spec.get("defaults", {})
+    jobs = []
+    for number, job in enumerate(spec.get("jobs", [])):
+        job = {**defaults, **job}
+        job.setdefault("name", f"job_{number}")
+        if "sweep" in job:
+            for sweep_number, changes in enumerate(Configuration.get_sweep_changes(**job.pop("sweep"))):
+                config = {section: {**job.get("config", {}).get(section, {}), **values}
+                          for section, values in changes.items()}
+                jobs.append({**job, "name": f"{job['name']}_{sweep_number}",
+                             "config": {**job.get("config", {}), **config}})
+            continue
+        jobs.append(job)
+
+    for job in jobs:
+        job.setdefault("type", "combined")
+        job.setdefault("method", "linear")
+        if job["type"] not in JOB_TYPES:
+            raise ValueError(f"Invalid type of job '{job['name']}', input should be one of {JOB_TYPES}")
+        if job["method"] not in METHODS:
+            raise ValueError(f"Invalid method of job '{job['name']}', input should be one of {METHODS}")
+        if job["type"] != "inverse" and "scatterers" not in job:
+            raise ValueError(f"Job '{job['name']}' needs scatterers for the forward problem")
+        if job["type"] == "inverse" and "input" not in job:
+            raise ValueError(f"Job '{job['name']}' needs an input dataset store with the measurements")
+
+    names = [job["name"] for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("Job names should be unique, every job writes the dataset store of its name")
+    return jobs, spec.get("output", "data/runs")
+
+
+def get_scatterer_params(scatterers):
+    """ scatterer_params with permittivities given as [real, imag] or strings converted to complex numbers """
+    scatterer_params = []
+    for param in scatterers:
+        permittivity = param["permittivity"]
+        if isinstance(permittivity, (list, tuple)):
+            permittivity = complex(*permittivity)
+        scatterer_params.append({**param, "permittivity": complex(permittivity)})
+    return scatterer_params
+
+
+def get_config(job):
+    """ Configuration of the job, Config with the changes of job["config"] """
+    return Configuration.from_config().replace(**job.get("config", {}))
+
+
+def solve_inverse(job, direct_power, total_power, config, frequencies=None):
+    """ Real and imaginary reconstruction of the job, zeros for the part its model does not reconstruct """
+    params = job.get("params", {})
+    method_params = job.get("method_params", {})
+    if job["method"] == "distorted_born":
+        from inverse_problem.nonlinear import DistortedBornSolver
+
+        if frequencies is not None:
+            raise ValueError("Distorted Born iterations reconstruct a single frequency, not wideband data")
+        solver = DistortedBornSolver(direct_power, total_power, job["model_name"], job["prior"], params,
+                                     profile=job.get("profile"), config=config, **method_params)
+        chi = solver.solve()
+    else:
+        solver = InverseProblemSolver(direct_power, total_power, job["model_name"], job["prior"], params,
+                                      job.get("profile"), config, frequencies)
+        chi = solver.solve_multiresolution(**method_params) if job["method"] == "multiresolution" else solver.solve()
+
+    if job["model_name"] == "prytov_imag":
+        return np.zeros(chi.shape), chi
+    if job["model_name"] == "prytov":
+        return chi, np.zeros(chi.shape)
+    return chi
+
+
+def render(job, directory, arrays, config):
+    """ Saves the figures of the arrays a job produced to directory """
+    import matplotlib
+    matplotlib.use("Agg")
+    from utils.plot_utils import PlotUtils
+
+    os.makedirs(directory, exist_ok=True)
+    figures = []
+    if "scatterer" in arrays:
+        figures.append(os.path.join(directory, "scatterer.png"))
+        PlotUtils.save_images(figures[-1], {"Scatterer: Real component": np.real(arrays["scatterer"]),
+                                            "Scatterer: Imaginary component": np.imag(arrays["scatterer"])},
+                              PlotUtils.get_doi_extent(config))
+    if "total_field" in arrays:
+        tx = job.get("render_tx", 0)
+        fields = [arrays[name] for name in ("total_field", "direct_field", "scattered_field")]
+        if fields[0].ndim == 3:
+            # Wideband fields are rendered at the first frequency
+            fields = [field[:, :, 0] for field in fields]
+        figures.append(os.path.join(directory, f"fields_tx{tx}.png"))
+        ForwardProblemSolver.get_field_plots(*fields, tx, figures[-1])
+    if "real_rec" in arrays:
+        figures.append(os.path.join(directory, "reconstruction.png"))
+        PlotUtils.save_images(figures[-1], {"Reconstruction: Real component": arrays["real_rec"],
+                                            "Reconstruction: Imaginary component": arrays["imag_rec"]},
+                              PlotUtils.get_doi_extent(config))
+    return figures
+
+
+def run_job(job, output):
+    """ Runs one job, returns a summary with the status, the dataset store path, the figures and the runtime """
+    start = time.perf_counter()
+    path = os.path.join(output, job["name"])
+    summary = {"name": job["name"], "type": job["type"], "store": path, "figures": []}
+    try:
+        config = get_config(job)
+        store = DatasetStore(path, mode="w")
+        store.set_attributes(job=job)
+        arrays = {}
+        frequencies = job.get("frequencies")
+
+        if job["type"] in ("forward", "combined"):
+            scatterer_params = get_scatterer_params(job["scatterers"])
+            scatterer = Scatterer("forward", None, scatterer_params, config).generate()
+            solver = ForwardProblemSolver(scatterer, job.get("engine", "mom"), job.get("engine_params"),
+                                          job.get("profile"), config)
+            if frequencies is not None:
+                forward_data = solver.generate_wideband_data(frequencies)
+            else:
+                forward_data = solver.generate_forward_data()
+            direct_field, direct_power, scattered_field, total_field, total_power = forward_data
+            store = ForwardProblemSolver.save_data(scatterer, direct_field, direct_power, scattered_field,
+                                                   total_field, total_power, path, config, frequencies)
+            arrays.update(scatterer=scatterer, direct_field=direct_field, scattered_field=scattered_field,
+                          total_field=total_field)
+        else:
+            input_store = DatasetStore(job["input"], mode="r")
+            direct_power = np.asarray(input_store["direct_power"])
+            total_power = input_store["total_power"][job.get("sample", 0)]
+            if frequencies is None:
+                frequencies = input_store.attributes.get("frequencies")
+            store.set_attributes(config=DatasetStore.get_config_attributes(config))
+            if frequencies is not None:
+                store.set_attributes(frequencies=frequencies)
+            store.put("direct_power", direct_power)
+            store.append(total_power=total_power)
+
+        if job["type"] in ("inverse", "combined"):
+            real_rec, imag_rec = solve_inverse(job, direct_power, total_power, config, frequencies)
+            reconstruction = {"real_rec": real_rec, "imag_rec": imag_rec}
+            if "scatterers" in job:
+                scatterer_params = get_scatterer_params(job["scatterers"])
+                reconstruction["scatterer_inverse"] = Scatterer("inverse", job.get("inverse_type"),
+                                                                scatterer_params, config).generate()
+            # Stored as the sample the measurements were appended to
+            store.append(**reconstruction)
+            arrays.update(real_rec=real_rec, imag_rec=imag_rec)
+
+        if job.get("render"):
+            with RENDER_LOCK:
+                summary["figures"] = render(job, os.path.join(path, "figures"), arrays, config)
+        summary["status"] = "done"
+    except Exception:
+        summary["status"] = "failed"
+        summary["error"] = traceback.format_exc()
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def get_rounds(jobs, output):
+    """ Jobs grouped into rounds that only read the dataset stores of jobs of earlier rounds """
+    paths = {os.path.normpath(os.path.join(output, job["name"])): job["name"] for job in jobs}
+    done, rounds, remaining = set(), [], list(jobs)
+    while remaining:
+        ready = [job for job in remaining if paths.get(os.path.normpath(job.get("input", "")), None) in done | {None}]
+        if not ready:
+            raise ValueError("Jobs read the dataset stores of each other in a cycle")
+        rounds.append(ready)
+        done |= {job["name"] for job in ready}
+        remaining = [job for job in remaining if job["name"] not in done]
+    return rounds
+
+
+def run_jobs(jobs, output, workers=1, threads=False):
+    """
+    Runs the jobs in order, or across a pool of worker processes (threads if threads) if workers > 1,
+    and returns their summaries; an inverse job with the store of another job as input runs after that job
+    """
+    executor_class = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    summaries = {}
+    for jobs_round in get_rounds(jobs, output):
+        if workers == 1:
+            results = [run_job(job, output) for job in jobs_round]
+        else:
+            with executor_class(max_workers=min(workers, len(jobs_round))) as executor:
+                results = list(executor.map(run_job, jobs_round, [output] * len(jobs_round)))
+        summaries.update({summary["name"]: summary for summary in results})
+    return [summaries[job["name"]] for job in jobs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run forward, inverse and combined jobs from a JSON or YAML spec")
+    parser.add_argument("spec", help="JSON spec, or YAML if pyyaml is installed")
+    parser.add_argument("--output", default=None, help="directory of the job dataset stores, overrides the spec")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes the jobs are run on")
+    parser.add_argument("--threads", action="store_true",
+                        help="run the jobs on worker threads, which share cached operators in memory")
+    parser.add_argument("--render", action="store_true", help="save the figures of every job")
+    parser.add_argument("--only", nargs="+", default=None, help="names of the jobs to run, all if not given")
+    args = parser.parse_args()
+
+    jobs, output = load_spec(args.spec)
+    output = args.output if args.output is not None else output
+    if args.only is not None:
+        jobs = [job for job in jobs if job["name"] in args.only]
+    if args.render:
+        jobs = [{**job, "render": True} for job in jobs]
+
+    summaries = run_jobs(jobs, output, args.workers, args.threads)
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, "summary.json"), "w") as file:
+        json.dump(summaries, file, indent=2)
+
+    for summary in summaries:
+        print(f"{summary['name']:<30} {summary['type']:<10} {summary['status']:<8} {summary['seconds']:8.1f} s")
+        if summary["status"] == "failed":
+            print(summary["error"])
+    return 1 if any(summary["status"] == "failed" for summary in summaries) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,6 @@
+import itertools
+from types import MappingProxyType
+
 import numpy as np
 
 
@@ -5,22 +8,27 @@ class ConfigUtils:
 
     @staticmethod
     def get_sensor_positions(count, room_length, room_width, origin_location):
-        # TODO: Convert to generic code for arbitrary sensor count and room size
-        sensor_x = [-1.5, -1.2, -0.9, -0.6, -0.3, 0,
-                    0.3, 0.6, 0.9, 1.2, 1.5, 1.5,
-                    1.5, 1.5, 1.5, 1.5, 1.5, 1.5,
-                    1.5, 1.5, 1.5, 1.2, 0.9, 0.6,
-                    0.3, 0, -0.3, -0.6, -0.9, -1.2,
-                    -1.5, -1.5, -1.5, -1.5, -1.5,
-                    -1.5, -1.5, -1.5, -1.5, -1.5]
-        sensor_y = [-1.5, -1.5, -1.5, -1.5, -1.5,
-                    -1.5, -1.5, -1.5, -1.5, -1.5,
-                    -1.5, -1.2, -0.9, -0.6, -0.3, 0,
-                    0.3, 0.6, 0.9, 1.2, 1.5, 1.5,
-                    1.5, 1.5, 1.5, 1.5, 1.5, 1.5,
-                    1.5, 1.5, 1.5, 1.2, 0.9, 0.6,
-                    0.3, 0, -0.3, -0.6, -0.9, -1.2]
-        sensor_positions = np.transpose(np.array([sensor_x, sensor_y]))
+        """
+        Sensors evenly spaced along the room walls, counter-clockwise from the bottom left corner
+        Output dimension - count x 2
+        """
+        perimeter = 2 * (room_length + room_width)
+        sensor_positions = []
+        for i in range(count):
+            distance = i * perimeter / count
+            if distance < room_length:
+                position = (-room_length / 2 + distance, -room_width / 2)
+            elif distance < room_length + room_width:
+                position = (room_length / 2, -room_width / 2 + distance - room_length)
+            elif distance < 2 * room_length + room_width:
+                position = (room_length / 2 - (distance - room_length - room_width), room_width / 2)
+            else:
+                position = (-room_length / 2, room_width / 2 - (distance - 2 * room_length - room_width))
+            sensor_positions.append(position)
+
+        sensor_positions = np.round(np.array(sensor_positions), 12)
+        if origin_location == "corner":
+            sensor_positions = sensor_positions + np.array([room_length / 2, room_width / 2])
         return sensor_positions
 
     @staticmethod
@@ -39,6 +47,28 @@ class ConfigUtils:
         return txrx_links
 
 
+class SensorConfig(dict):
+    """
+    Sensor parameters, the "positions" and "links" derived from them are computed on first access
+    and kept until they are assigned explicitly
+    """
+
+    def __init__(self, room, **sensors):
+        super().__init__(**sensors)
+        self.room = room
+
+    def __missing__(self, key):
+        if key == "positions":
+            value = ConfigUtils.get_sensor_positions(self["count"], self.room["length"], self.room["width"],
+                                                     self.room["origin"])
+        elif key == "links":
+            value = ConfigUtils.get_sensor_links(self["count"], self["transceivers"])
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
+
 class Config:
 
     # System parameters
@@ -65,10 +95,91 @@ class Config:
     }
 
     # Sensor parameters
-    sensors = {
-        "count": 40,
-        "transceivers": True
+    sensors = SensorConfig(
+        room,
+        count=40,
+        transceivers=True
+    )
+
+    # Cache of scatterer independent operators
+    cache = {
+        "enabled": True,
+        "directory": "data/cache",
+        "max_size": 2 * 1024 ** 3,  # bytes
+        "memory_size": 512 * 1024 ** 2  # bytes of operators kept in memory, shared by the threads of a process
     }
-    sensors["positions"] = ConfigUtils.get_sensor_positions(sensors["count"], room["length"], room["width"], room["origin"])
-    sensors["links"] = ConfigUtils.get_sensor_links(sensors["count"], sensors["transceivers"])
 
+
+class Configuration:
+    """
+    Immutable configuration with the sections of Config, read the same way (config.doi["inverse_grids"]), so solvers
+    given different configurations can run side by side in one process; Config is the default of every config argument
+        base = Configuration.from_config()
+        config = base.replace(system={"frequency": 5e9}, doi={"inverse_grids": 25})
+    Sensor positions follow from the sensor count and room unless given, links from the count and transceivers
+    """
+
+    sections = ("system", "room", "doi", "sensors", "cache")
+
+    def __init__(self, system, room, doi, sensors, cache):
+        sensors = {key: value for key, value in sensors.items() if key != "links"}
+        if "positions" not in sensors:
+            sensors["positions"] = ConfigUtils.get_sensor_positions(sensors["count"], room["length"], room["width"],
+                                                                    room["origin"])
+        sensors["positions"] = np.array(sensors["positions"], dtype=float)
+        sensors["positions"].flags.writeable = False
+        sensors["links"] = tuple(ConfigUtils.get_sensor_links(sensors["count"], sensors["transceivers"]))
+
+        values = {"system": system, "room": room, "doi": doi, "sensors": sensors, "cache": cache}
+        for name in Configuration.sections:
+            object.__setattr__(self, name, MappingProxyType(dict(values[name])))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Configuration is immutable, use replace to derive a modified one")
+
+    def __reduce__(self):
+        return Configuration, tuple(dict(getattr(self, name)) for name in Configuration.sections)
+
+    def __repr__(self):
+        return (f"Configuration(frequency={self.system['frequency']:g}, doi={self.doi['length']}x{self.doi['width']}, "
+                f"grids={self.doi['forward_grids']}/{self.doi['inverse_grids']}, sensors={self.sensors['count']})")
+
+    @staticmethod
+    def from_config(config=None):
+        """ Immutable copy of config, of the current values of Config if None """
+        config = config if config is not None else Config
+        return Configuration(config.system, config.room, config.doi,
+                             {**config.sensors, "positions": config.sensors["positions"]}, config.cache)
+
+    def replace(self, **sections):
+        """
+        Copy with the given sections updated, e.g. replace(doi={"inverse_grids": 25})
+        Sensor positions are derived again when the sensor count or the room changes and no positions are given
+        """
+        for name in sections:
+            if name not in Configuration.sections:
+                raise ValueError(f"Invalid configuration section '{name}', input should be one of {Configuration.sections}")
+        values = {name: {**getattr(self, name), **sections.get(name, {})} for name in Configuration.sections}
+        sensors = sections.get("sensors", {})
+        if ("count" in sensors or "room" in sections) and "positions" not in sensors:
+            del values["sensors"]["positions"]
+        return Configuration(**values)
+
+    def sweep(self, **sections):
+        """
+        Configurations for every combination of the listed values, in the order of itertools.product
+            sweep(system={"frequency": [2.4e9, 5e9]}, doi={"inverse_grids": [25, 50]}) gives four configurations
+        """
+        return [self.replace(**changes) for changes in Configuration.get_sweep_changes(**sections)]
+
+    @staticmethod
+    def get_sweep_changes(**sections):
+        """ Section changes, as accepted by replace, of every combination of the listed values """
+        axes = [(name, key, values) for name, changes in sections.items() for key, values in changes.items()]
+        sweep = []
+        for combination in itertools.product(*[values for _, _, values in axes]):
+            changes = {}
+            for (name, key, _), value in zip(axes, combination):
+                changes.setdefault(name, {})[key] = value
+            sweep.append(changes)
+        return sweep
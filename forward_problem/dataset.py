@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from config import Config
+from scatterer.scatterer import Scatterer
+from forward_problem.solve import ForwardProblemSolver
+from utils.store_utils import DatasetStore
+
+
+class ScattererSampler:
+    """ Draws random scatterer_params lists, as accepted by Scatterer, from configurable ranges """
+
+    ranges = {
+        "shapes": ["circle", "square", "rectangle"],
+        "count": (1, 3),                    # number of objects, inclusive
+        "size": (0.05, 0.2),                # meters, radius or half side
+        "permittivity_real": (1.5, 5),
+        "permittivity_imag": (0, 0.5)
+    }
+
+    def __init__(self, ranges=None, seed=0):
+        self.ranges = {**ScattererSampler.ranges, **(ranges if ranges is not None else {})}
+        self.seed = seed
+
+    def get_center_range(self, size, config=None):
+        """ Centers for which an object of the given size lies completely inside the DOI of config, Config if None """
+        config = config if config is not None else Config
+        length = config.doi["length"]
+        if config.doi["origin"] == "center":
+            return -length / 2 + size, length / 2 - size
+        return size, length - size
+
+    def sample(self, index, config=None):
+        """ Scatterer parameters of sample number index, the same index always gives the same scatterer """
+        rng = np.random.default_rng([self.seed, index])
+        count = rng.integers(self.ranges["count"][0], self.ranges["count"][1] + 1)
+
+        scatterer_params = []
+        for _ in range(count):
+            shape = str(rng.choice(self.ranges["shapes"]))
+            param = {
+                "shape": shape,
+                "permittivity": complex(rng.uniform(*self.ranges["permittivity_real"]),
+                                        rng.uniform(*self.ranges["permittivity_imag"]))
+            }
+            if shape == "rectangle":
+                param["size1"] = rng.uniform(*self.ranges["size"])
+                param["size2"] = rng.uniform(*self.ranges["size"])
+                extent = (param["size1"], param["size2"])
+            else:
+                param["size"] = rng.uniform(*self.ranges["size"])
+                extent = (param["size"], param["size"])
+            param["center_x"] = rng.uniform(*self.get_center_range(extent[0], config))
+            param["center_y"] = rng.uniform(*self.get_center_range(extent[1], config))
+            scatterer_params.append(param)
+        return scatterer_params
+
+
+class DatasetGenerator:
+    """
+    Generates forward data for randomly sampled scatterers across a process pool
+    Workers solve shards of chunk_size samples, which are appended to a DatasetStore in the output directory as they
+    complete; samples already in the store are skipped so an interrupted run resumes where it stopped
+    """
+
+    def __init__(self, output_directory, sampler=None, engine="mom", params=None, inverse_type=None,
+                 chunk_size=100, workers=None, config=None):
+        self.output_directory = output_directory
+        self.sampler = sampler if sampler is not None else ScattererSampler()
+        self.engine = engine
+        self.params = params if params is not None else {}
+        self.inverse_type = inverse_type
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.config = config if config is not None else Config
+
+    def prepare(self):
+        """
+        Computes the scatterer independent operators once in the parent process,
+        workers then load them from the operator cache instead of recomputing them
+        Returns the dataset store, created with the direct field, direct power and generation settings if new
+        """
+        m = self.config.doi["forward_grids"]
+        solver = ForwardProblemSolver(np.ones((m, m)), config=self.config)
+        direct_field, direct_power = solver.scatterer_independent_data()
+        solver.model.get_incident_field()
+        solver.model.get_offset_hankel_table()
+        solver.model.get_receiver_greens()
+
+        store = DatasetStore(self.output_directory, chunk_size=self.chunk_size)
+        if "direct_field" not in store:
+            store.set_attributes(config=DatasetStore.get_config_attributes(self.config), engine=self.engine, params=self.params,
+                                 inverse_type=self.inverse_type, sampler_seed=self.sampler.seed,
+                                 sampler_ranges=self.sampler.ranges)
+            store.put("direct_field", direct_field)
+            store.put("direct_power", direct_power)
+        return store
+
+    @staticmethod
+    def generate_shard(sampler, indices, engine, params, inverse_type, config):
+        scatterers, inverse_scatterers, scatterer_params = [], [], []
+        scattered_fields, total_fields, total_powers = [], [], []
+        for index in indices:
+            sample_params = sampler.sample(index, config)
+            scatterer = Scatterer("forward", None, sample_params, config).generate()
+            solver = ForwardProblemSolver(scatterer, engine, params, config=config)
+            direct_field, _ = solver.scatterer_independent_data()
+            scattered_field, total_field, total_power = solver.scatterer_dependent_data(direct_field)
+
+            scatterers.append(scatterer)
+            inverse_scatterers.append(Scatterer("inverse", inverse_type, sample_params, config).generate())
+            scatterer_params.append(json.dumps(sample_params, default=lambda value: [value.real, value.imag]))
+            scattered_fields.append(scattered_field)
+            total_fields.append(total_field)
+            total_powers.append(total_power)
+
+        return {
+            "index": np.asarray(indices),
+            "scatterer": np.stack(scatterers),
+            "scatterer_inverse": np.stack(inverse_scatterers),
+            "scatterer_params": np.asarray(scatterer_params),
+            "scattered_field": np.stack(scattered_fields),
+            "total_field": np.stack(total_fields),
+            "total_power": np.stack(total_powers)
+        }
+
+    def generate(self, num_samples):
+        """
+        Generates num_samples samples and returns throughput statistics of this run
+        """
+        store = self.prepare()
+        stored = set(store["index"][:].tolist()) if "index" in store else set()
+        missing = [index for index in range(num_samples) if index not in stored]
+        shards = [missing[start:start + self.chunk_size] for start in range(0, len(missing), self.chunk_size)]
+
+        start = time.perf_counter()
+        completed = 0
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            for shard, indices in enumerate(shards):
+                future = executor.submit(DatasetGenerator.generate_shard, self.sampler, indices,
+                                         self.engine, self.params, self.inverse_type, self.config)
+                futures[future] = shard
+            for future in as_completed(futures):
+                data = future.result()
+                store.extend(**data)
+                completed += len(data["index"])
+                elapsed = time.perf_counter() - start
+                print(f"Shard {futures[future]}: {completed} samples in {elapsed:.1f} s, {completed / elapsed:.2f} samples/s")
+
+        elapsed = time.perf_counter() - start
+        return {
+            "samples": completed,
+            "skipped_samples": num_samples - len(missing),
+            "seconds": elapsed,
+            "samples_per_second": completed / elapsed if elapsed > 0 else 0.0
+        }
+
+
+if __name__ == '__main__':
+
+    generator = DatasetGenerator("data/dataset", ScattererSampler(seed=0), chunk_size=10)
+    statistics = generator.generate(40)
+    print(statistics)
@@ -0,0 +1,235 @@
+import os
+import sys
+import warnings
+import numpy as np
+from scipy import fft
+from scipy.sparse.linalg import LinearOperator, gmres
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from forward_problem.model import MethodOfMomentModel
+
+
+class FFTMethodOfMomentModel(MethodOfMomentModel):
+    """
+    Method of Moments model in which the impedance matrix is never formed.
+    On the uniform DOI grid the interaction between two grids depends only on their (row, column) offset,
+    so the impedance operator is block-Toeplitz and is applied as a 2D FFT convolution inside a Krylov solver.
+    BiCGSTAB iterates all transmitters together in vectorized form, convolving batch_size transmitters per FFT call.
+    """
+
+    # Krylov solver parameters
+    method = "bicgstab"         # values: {"bicgstab", "gmres"}
+    tolerance = 1e-6
+    max_iter = 1000
+    # Number of transmitters convolved per FFT call, larger batches only pay off when several cores run the FFTs
+    batch_size = 1
+
+    def __init__(self, grid_permittivities, method=None, tolerance=None, max_iter=None, precision=None, config=None):
+        super().__init__(grid_permittivities, precision, config)
+
+        if method is not None:
+            self.method = method
+        if tolerance is not None:
+            self.tolerance = tolerance
+        if max_iter is not None:
+            self.max_iter = max_iter
+
+        self.kernel_spectrum = None
+        self.preconditioner = None
+        self.iterations = None      # Krylov iterations used for every transmitter
+
+    @staticmethod
+    def get_padded_shape(rows, cols):
+        """ Smallest FFT friendly shape for which circular convolution over a rows x cols block has no aliasing """
+        return fft.next_fast_len(2 * rows - 1), fft.next_fast_len(2 * cols - 1)
+
+    def get_kernel_spectrum(self, rows, cols, dtype=complex):
+        """
+        FFT of the impedance kernel for a rows x cols block of grids, embedded in a padded circulant array
+        Entry at offset (0, 0) holds the self term, every other offset the mutual term
+        """
+        kernel = self.C1 * self.C2 * self.get_offset_hankel_table()[:rows, :cols]
+        kernel[0, 0] = self.C1 * self.C3
+
+        # Negative offsets wrap around to the end of the padded array, nothing wraps along an axis of a single grid
+        shape = FFTMethodOfMomentModel.get_padded_shape(rows, cols)
+        circulant = np.zeros(shape, dtype=dtype)
+        circulant[:rows, :cols] = kernel
+        circulant[shape[0] - rows + 1:, :cols] = kernel[:0:-1, :]
+        circulant[:rows, shape[1] - cols + 1:] = kernel[:, :0:-1]
+        circulant[shape[0] - rows + 1:, shape[1] - cols + 1:] = kernel[:0:-1, :0:-1]
+        return fft.fft2(circulant, workers=-1)
+
+    def get_field_from_scattering(self):
+        """ Impedance matrix restricted to the grids containing object, returned as a linear operator
+        that applies the mutual interaction through FFT convolution over the bounding box of the object """
+
+        n = len(self.object_grid_indices)
+        if n == 0:
+            # No object, there is no current and the scattered field is zero
+            self.kernel_spectrum = self.preconditioner = None
+            return LinearOperator((0, 0), matvec=lambda current: np.zeros(0, dtype=self.dtype),
+                                  matmat=lambda currents: np.zeros((0, currents.shape[1]), dtype=self.dtype),
+                                  dtype=self.dtype)
+
+        m = self.m
+        object_rows = self.object_grid_indices % m
+        object_cols = self.object_grid_indices // m
+        rows = object_rows.max() - object_rows.min() + 1
+        cols = object_cols.max() - object_cols.min() + 1
+        box_indices = (object_rows - object_rows.min()) + rows * (object_cols - object_cols.min())
+        self.kernel_spectrum = self.get_kernel_spectrum(rows, cols, self.dtype)
+
+        permittivities = self.unrolled_permittivities[self.object_grid_indices]
+        b1 = self.impedance * permittivities / (self.wave_number * (permittivities - 1))
+        diagonal = (- 1j * b1).astype(self.dtype)
+
+        # Currents are batched along the first axis, the grids of every current laid out transposed (cols x rows)
+        kernel_spectrum = np.ascontiguousarray(self.kernel_spectrum.T)
+
+        def convolve(currents):
+            """
+            Mutual interaction of every row of currents, batched FFTs along one axis at a time skip the lines of the
+            padded array that are zero on input or discarded on output, about a quarter of a full 2D FFT each
+            """
+            unrolled = np.zeros((len(currents), rows * cols), dtype=self.dtype)
+            unrolled[:, box_indices] = currents
+            spectrum = fft.fft(unrolled.reshape((-1, cols, rows)), n=kernel_spectrum.shape[1], axis=2, workers=-1)
+            spectrum = fft.fft(spectrum, n=kernel_spectrum.shape[0], axis=1, workers=-1, overwrite_x=True)
+            spectrum *= kernel_spectrum
+            convolved = fft.ifft(spectrum, axis=1, workers=-1, overwrite_x=True)[:, :cols]
+            convolved = fft.ifft(convolved, axis=2, workers=-1, overwrite_x=True)[:, :, :rows]
+            return convolved.reshape((-1, rows * cols))[:, box_indices]
+
+        def apply_impedance(currents):
+            """ Z applied to every row of currents (number of currents x number of object grids) """
+            batches = [convolve(currents[start:start + self.batch_size])
+                       for start in range(0, len(currents), self.batch_size)]
+            return np.concatenate(batches) + diagonal * currents
+
+        self.apply_impedance = apply_impedance
+        Z = LinearOperator((n, n), matvec=lambda current: apply_impedance(np.reshape(current, (1, -1)))[0],
+                           matmat=lambda currents: apply_impedance(currents.T).T, dtype=self.dtype)
+
+        # Jacobi preconditioner built from the diagonal of the impedance matrix
+        self.inverse_diagonal = 1 / (self.C1 * self.C3 + diagonal)
+        self.preconditioner = LinearOperator((n, n), matvec=lambda x: self.inverse_diagonal * np.ravel(x),
+                                             dtype=self.dtype)
+        return Z
+
+    def get_induced_current(self, object_field):
+        # Only consider that part of incident field which falls on grids containing object
+        with self.profiler.stage("incident_field"):
+            self.get_incident_field()
+            incident_field_on_object = - self.incident_field[self.object_grid_indices].astype(self.dtype)
+
+        if self.method not in ("bicgstab", "gmres"):
+            raise ValueError("Invalid Krylov method, input should be either 'bicgstab' or 'gmres'")
+
+        J1 = np.zeros(incident_field_on_object.shape, dtype=self.dtype)
+        self.iterations = np.zeros(self.tx_count, dtype=int)
+        if len(self.object_grid_indices) == 0:
+            self.residual = 0.0
+            return J1
+        with self.profiler.stage("current_solve"):
+            if self.method == "bicgstab":
+                J1 = self.solve_bicgstab(incident_field_on_object)
+            else:
+                for tx in range(self.tx_count):
+                    counter = []
+                    J1[:, tx], info = gmres(object_field, incident_field_on_object[:, tx], M=self.preconditioner,
+                                            rtol=self.tolerance, maxiter=self.max_iter, restart=50,
+                                            callback_type="pr_norm", callback=lambda *args: counter.append(1))
+                    self.iterations[tx] = len(counter)
+                    if info > 0:
+                        warnings.warn(f"gmres did not converge for transmitter {tx} within {self.max_iter} iterations")
+        self.profiler.record_arrays(kernel_spectrum=self.kernel_spectrum, current_on_object=J1)
+
+        residual = object_field.matmat(J1) - incident_field_on_object
+        self.residual = np.linalg.norm(residual) / np.linalg.norm(incident_field_on_object)
+
+        return J1
+
+    def solve_bicgstab(self, B):
+        """
+        Jacobi preconditioned BiCGSTAB for Z @ X = B, iterating every column of B (one per transmitter) together
+        Every iteration applies Z to all unconverged columns with one batched FFT convolution, columns stop once their
+        residual falls below self.tolerance times their norm; iterations per column are kept in self.iterations
+        """
+        # Transmitters are rows of the working arrays, which only hold the transmitters still iterating
+        B = np.ascontiguousarray(B.T)
+        X = np.zeros(B.shape, dtype=self.dtype)
+        targets = self.tolerance * np.linalg.norm(B, axis=1)
+        active = np.flatnonzero(np.linalg.norm(B, axis=1) > targets)
+
+        x = X[active]
+        r = B[active]
+        r_hat = r.copy()
+        p = np.zeros(r.shape, dtype=self.dtype)
+        v = np.zeros(r.shape, dtype=self.dtype)
+        rho = alpha = omega = np.ones((len(active), 1), dtype=self.dtype)
+
+        def row_dot(A1, A2):
+            return np.einsum('ij,ij->i', A1.conj(), A2)[:, None]
+
+        iteration = 0
+        while len(active) and iteration < self.max_iter:
+            iteration += 1
+            rho_new = row_dot(r_hat, r)
+            p = r + (rho_new / rho) * (alpha / omega) * (p - omega * v)
+            p_hat = self.inverse_diagonal * p
+            v = self.apply_impedance(p_hat)
+            alpha = rho_new / row_dot(r_hat, v)
+            s = r - alpha * v
+
+            s_hat = self.inverse_diagonal * s
+            t = self.apply_impedance(s_hat)
+            # t vanishes for transmitters that converged within the half step, they take no second step
+            t_norm = row_dot(t, t)
+            omega = row_dot(t, s) / np.where(t_norm == 0, 1, t_norm)
+            x += alpha * p_hat + omega * s_hat
+            r = s - omega * t
+            rho = rho_new
+
+            # Converged transmitters, and transmitters that broke down, leave the working arrays
+            keep = (np.linalg.norm(r, axis=1) > targets[active]) & np.isfinite(omega[:, 0]) & (omega[:, 0] != 0) \
+                & (rho[:, 0] != 0)
+            self.iterations[active] = iteration
+            if not keep.all():
+                X[active] = x
+                active = active[keep]
+                x, r, r_hat, p, v = x[keep], r[keep], r_hat[keep], p[keep], v[keep]
+                rho, alpha, omega = rho[keep], alpha[keep], omega[keep]
+        X[active] = x
+
+        for tx in np.flatnonzero(np.linalg.norm(B - self.apply_impedance(X), axis=1) > targets * (1 + 1e-3)):
+            warnings.warn(f"bicgstab did not converge for transmitter {tx} within {self.max_iter} iterations")
+        return X.T
+
+if __name__ == '__main__':
+
+    from config import Configuration
+    from forward_problem.solve import ForwardProblemSolver
+
+    # Scattered field of the FFT engine against the dense Method of Moments, including objects one grid tall or wide
+    config = Configuration.from_config().replace(doi={"forward_grids": 30}, cache={"enabled": False})
+    objects = {
+        "single grid": (slice(12, 13), slice(7, 8)),
+        "one row": (slice(12, 13), slice(5, 20)),
+        "one column": (slice(3, 18), slice(7, 8)),
+        "block": (slice(10, 16), slice(4, 9))
+    }
+    for name, index in objects.items():
+        permittivities = np.ones((30, 30), dtype=complex)
+        permittivities[index] = 3 + 0.2j
+        dense = ForwardProblemSolver(permittivities, "mom", config=config).generate_forward_data()[2]
+        fast = ForwardProblemSolver(permittivities, "fft", {"tolerance": 1e-10}, config=config).generate_forward_data()[2]
+        error = np.linalg.norm(fast - dense) / np.linalg.norm(dense)
+        print(f"{name:12s} relative error {error:.2e}")
+        assert error < 1e-8
+
+    # Without object both engines give a zero scattered field
+    empty = np.ones((30, 30))
+    assert not ForwardProblemSolver(empty, "fft", config=config).generate_forward_data()[2].any()
+    assert not ForwardProblemSolver(empty, "mom", config=config).generate_forward_data()[2].any()
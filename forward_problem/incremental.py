@@ -0,0 +1,196 @@
+import os
+import sys
+import numpy as np
+from scipy.linalg import inv, lu_factor, lu_solve, get_lapack_funcs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from forward_problem.model import MethodOfMomentModel
+
+
+class IncrementalMethodOfMomentModel(MethodOfMomentModel):
+    """
+    Method of Moments model for a sequence of scatterers that differ in a few grids, e.g. a person moving through the room
+    The inverse of the impedance matrix is kept between scatterers and corrected with low-rank updates:
+        modified grids - Sherman-Morrison-Woodbury update of the changed diagonal entries
+        removed grids  - Schur complement of the removed block in the inverse
+        added grids    - block bordering with the Schur complement of the new block
+    so the cost of an update scales with the number of changed grids instead of the number of object grids.
+    A full solve only keeps the LU factorization, as the dense model does. The explicit inverse is formed from it on the
+    first low-rank update, because all three updates act on the inverse directly.
+    """
+
+    # Changes touching more than this fraction of the object grids are solved from scratch
+    max_update_fraction = 0.25
+    # Number of consecutive low-rank updates after which the inverse is recomputed to bound round-off drift
+    refresh_every = 50
+    # Whether the residual of every current is evaluated, which assembles Z again in blocks of rows and so costs as much
+    # as a full assembly; the residual is reported as None if not
+    check_residual = False
+
+    def __init__(self, grid_permittivities, precision=None, max_update_fraction=None, refresh_every=None, config=None):
+        super().__init__(grid_permittivities, precision, config)
+
+        if max_update_fraction is not None:
+            self.max_update_fraction = max_update_fraction
+        if refresh_every is not None:
+            self.refresh_every = refresh_every
+
+        # State kept from the previous scatterer, ordered like self.object_grid_indices
+        self.Z_factors = None       # LU factorization from the last full solve, until the inverse is needed
+        self.Z_inverse = None
+        self.diagonal = None
+        self.previous_grid_indices = None
+        self.previous_permittivities = None
+
+        self.updates_since_refresh = 0
+        self.last_update = None     # "full" or "incremental", with the number of changed grids
+
+    def update_scatterer(self, grid_permittivities):
+        self.grid_permittivities = grid_permittivities
+
+    def find_grids_with_object(self):
+        super().find_grids_with_object()
+        # Keep the order of the grids held in the inverse, new grids are appended at the end
+        if self.previous_grid_indices is not None:
+            kept = self.previous_grid_indices[np.isin(self.previous_grid_indices, self.object_grid_indices)]
+            added = np.setdiff1d(self.object_grid_indices, self.previous_grid_indices)
+            self.object_grid_indices = np.concatenate((kept, added))
+
+    def get_changes(self):
+        """ Grids removed from, added to and modified in the object since the previous scatterer """
+        removed = np.nonzero(~np.isin(self.previous_grid_indices, self.object_grid_indices))[0]
+        kept = np.delete(self.previous_grid_indices, removed)
+        added = self.object_grid_indices[len(kept):]
+        modified = np.nonzero(self.unrolled_permittivities[kept] != self.previous_permittivities[kept])[0]
+        return removed, added, modified
+
+    def get_field_from_scattering(self):
+        """
+        Updates the inverse of the impedance matrix to the current scatterer and returns it
+        Falls back to assembling and factorizing the full impedance matrix on the first call or for large changes,
+        in which case the LU factorization is returned instead
+        """
+        if self.previous_grid_indices is not None and self.updates_since_refresh < self.refresh_every:
+            removed, added, modified = self.get_changes()
+            changed = len(removed) + len(added) + len(modified)
+            if changed <= self.max_update_fraction * max(len(self.object_grid_indices), 1):
+                if self.Z_inverse is None:
+                    self.Z_inverse = self.invert_factors()
+                self.remove_grids(removed)
+                self.modify_grids(modified)
+                self.add_grids(added)
+                self.updates_since_refresh += 1
+                self.last_update = ("incremental", changed)
+                self.save_state()
+                return self.Z_inverse
+
+        Z = super().get_field_from_scattering()
+        if len(Z):
+            self.Z_factors = lu_factor(Z, overwrite_a=True, check_finite=False)
+            self.Z_inverse = None
+        else:
+            self.Z_factors = None
+            self.Z_inverse = Z
+        self.diagonal = self.get_self_impedance(self.object_grid_indices)
+        self.updates_since_refresh = 0
+        self.last_update = ("full", len(self.object_grid_indices))
+        self.save_state()
+        return self.Z_inverse if self.Z_factors is None else self.Z_factors
+
+    def invert_factors(self):
+        """ Inverse of Z from the LU factorization of the last full solve, which is consumed in the process """
+        lu, piv = self.Z_factors
+        getri, getri_lwork = get_lapack_funcs(("getri", "getri_lwork"), (lu,))
+        # The blocked inversion needs the optimal workspace, the default one falls back to an unblocked and far slower loop
+        lwork, _ = getri_lwork(len(lu))
+        Z_inverse, info = getri(lu, piv, lwork=int(lwork.real), overwrite_lu=True)
+        if info:
+            raise np.linalg.LinAlgError("Impedance matrix is singular")
+        self.Z_factors = None
+        return Z_inverse
+
+    def save_state(self):
+        self.previous_grid_indices = self.object_grid_indices.copy()
+        self.previous_permittivities = self.unrolled_permittivities.copy()
+
+    def remove_grids(self, positions):
+        """ Inverse of Z without rows and columns at positions: P - Q S^-1 R for the inverse [[P, Q], [R, S]] """
+        if not len(positions):
+            return
+        keep = np.delete(np.arange(len(self.Z_inverse)), positions)
+        S = self.Z_inverse[np.ix_(positions, positions)]
+        Q = self.Z_inverse[np.ix_(keep, positions)]
+        R = self.Z_inverse[np.ix_(positions, keep)]
+        self.Z_inverse = self.Z_inverse[np.ix_(keep, keep)] - Q @ np.linalg.solve(S, R)
+        self.diagonal = self.diagonal[keep]
+
+    def modify_grids(self, positions):
+        """ Woodbury update for a change of the self terms at positions: (Z + U D U.T)^-1 with U the unit columns """
+        if not len(positions):
+            return
+        grid_indices = self.object_grid_indices[positions]
+        new_diagonal = self.get_self_impedance(grid_indices)
+        delta = new_diagonal - self.diagonal[positions]
+        capacitance = np.diag(1 / delta) + self.Z_inverse[np.ix_(positions, positions)]
+        self.Z_inverse = self.Z_inverse - self.Z_inverse[:, positions] @ np.linalg.solve(capacitance, self.Z_inverse[positions, :])
+        self.diagonal[positions] = new_diagonal
+
+    def add_grids(self, grid_indices):
+        """ Bordered inverse of [[Z, B], [B.T, C]] through the Schur complement C - B.T Z^-1 B """
+        if not len(grid_indices):
+            return
+        existing = self.object_grid_indices[:len(self.Z_inverse)]
+        B = self.get_mutual_impedance(existing, grid_indices)
+        C = self.get_mutual_impedance(grid_indices, grid_indices)
+        new_diagonal = self.get_self_impedance(grid_indices)
+        C[np.diag_indices(len(grid_indices))] = new_diagonal
+
+        Z_inverse_B = self.Z_inverse @ B
+        S_inverse = inv(C - B.T @ Z_inverse_B, check_finite=False)
+        top_right = - Z_inverse_B @ S_inverse
+        self.Z_inverse = np.block([[self.Z_inverse - top_right @ Z_inverse_B.T, top_right],
+                                   [top_right.T, S_inverse]]).astype(self.dtype)
+        self.diagonal = np.concatenate((self.diagonal, new_diagonal))
+
+    def get_induced_current(self, object_field):
+        # Only consider that part of incident field which falls on grids containing object
+        with self.profiler.stage("incident_field"):
+            self.get_incident_field()
+            incident_field_on_object = - self.incident_field[self.object_grid_indices].astype(self.dtype)
+
+        # A full solve hands over the LU factorization, an incremental one the updated inverse
+        with self.profiler.stage("current_solve"):
+            if isinstance(object_field, tuple):
+                J1 = lu_solve(object_field, incident_field_on_object, check_finite=False)
+            else:
+                J1 = object_field @ incident_field_on_object
+        if isinstance(object_field, tuple):
+            self.profiler.record_arrays(impedance_factors=object_field[0], current_on_object=J1)
+        else:
+            self.profiler.record_arrays(impedance_inverse=object_field, current_on_object=J1)
+
+        self.residual = None
+        if self.check_residual:
+            with self.profiler.stage("residual"):
+                self.residual = self.get_residual(J1, incident_field_on_object)
+
+        return J1
+
+    def get_residual(self, current, incident_field_on_object):
+        """
+        Relative residual ||Z J - E|| / ||E|| of the current for the impedance matrix of the current scatterer
+        Only the inverse of Z is kept, so Z is assembled again one block of rows at a time
+        """
+        norm = np.linalg.norm(incident_field_on_object)
+        if not norm:
+            return 0.0
+        n = len(self.object_grid_indices)
+        squared_norm = 0.0
+        block = 256
+        for start in range(0, n, block):
+            positions = np.arange(start, min(start + block, n))
+            Z_rows = self.get_mutual_impedance(self.object_grid_indices[positions], self.object_grid_indices)
+            Z_rows[np.arange(len(positions)), positions] = self.diagonal[positions]
+            squared_norm += np.linalg.norm(Z_rows @ current - incident_field_on_object[positions]) ** 2
+        return np.sqrt(squared_norm) / norm
@@ -1,45 +1,69 @@
 import numpy as np
 from scipy.special import jv as bessel1
 from scipy.special import hankel1
+from scipy.linalg import lu_factor, lu_solve
 from datetime import datetime
 
 from config import Config
 from utils.doi_utils import DOIUtils
+from utils.cache_utils import OperatorCache
+from utils.profile_utils import Profiler
 
 
 class MethodOfMomentModel:
 
-    # System parameters
-    frequency = Config.system["frequency"]
-    wavelength = 3e8 / frequency
-    wave_number = 2 * np.pi / wavelength
     impedance = 120 * np.pi
 
-    # Room parameters
-    m = Config.doi["forward_grids"]
-    num_grids = m ** 2
-    grid_positions = DOIUtils.get_grid_centroids("forward")
-    grid_radius = DOIUtils.get_grid_radius("forward")
-
-    # Sensor parameters
-    transceiver = Config.sensors["transceivers"]
-    rx_count = Config.sensors["count"]
-    tx_count = Config.sensors["count"]
-    sensor_positions = Config.sensors["positions"]
-
     nan_remove = True
     noise_level = 0
 
-    # Constants used in code
-    C1 = -impedance * np.pi * (grid_radius / 2)
-    C2 = bessel1(1, wave_number * grid_radius)
-    C3 = hankel1(1, wave_number * grid_radius)
-
-    def __init__(self, grid_permittivities):
+    # Numerical precision of the impedance matrix and the induced current, values: {"single", "double"}
+    # "double" (complex128) holds Z and its LU factor in twice the memory of the complex64 Z assembled before this
+    # setting existed, and its outputs differ from that single precision assembly by about 1e-7 relative;
+    # "single" keeps complex64 end to end and halves the memory when that accuracy is enough
+    precision = "double"
+    dtypes = {"single": np.complex64, "double": np.complex128}
+
+    def __init__(self, grid_permittivities, precision=None, config=None):
+        """ config - Configuration of the frequency, DOI and sensors, Config if None """
+        self.config = config if config is not None else Config
+
+        # System parameters
+        self.frequency = self.config.system["frequency"]
+        self.wavelength = 3e8 / self.frequency
+        self.wave_number = 2 * np.pi / self.wavelength
+
+        # Room parameters
+        self.m = self.config.doi["forward_grids"]
+        self.num_grids = self.m ** 2
+        self.grid_positions = DOIUtils.get_grid_centroids("forward", config=self.config)
+        self.grid_radius = DOIUtils.get_grid_radius("forward", config=self.config)
+
+        # Sensor parameters
+        self.transceiver = self.config.sensors["transceivers"]
+        self.rx_count = self.config.sensors["count"]
+        self.tx_count = self.config.sensors["count"]
+        self.sensor_positions = self.config.sensors["positions"]
+
+        # Constants used in code
+        self.C1 = -self.impedance * np.pi * (self.grid_radius / 2)
+        self.C2 = bessel1(1, self.wave_number * self.grid_radius)
+        self.C3 = hankel1(1, self.wave_number * self.grid_radius)
 
         self.grid_permittivities = grid_permittivities
         self.grid_object_indices = None
 
+        # Frequency independent distances, see get_distances, the models of a wideband solve share one dictionary
+        self.distances = {}
+
+        if precision is not None:
+            self.precision = precision
+        if self.precision not in self.dtypes:
+            raise ValueError("Invalid precision value, input should be either 'single' or 'double'")
+        self.dtype = self.dtypes[self.precision]
+        self.residual = None  # Relative residual of the induced current solve
+        self.profiler = Profiler(enabled=False)  # Replaced by the profiler of ForwardProblemSolver
+
         # Do not change with scatterer
         self.direct_field = None  # Direct field at receiver
         self.direct_power = None  # Direct power at receiver
@@ -52,21 +76,36 @@ class MethodOfMomentModel:
         self.total_field = None  # Total field obtained at receiver
         self.total_power = None  # Total power obtained at receiver
 
+    def get_distances(self, name):
+        """
+        Distance matrix computed on first use and kept in self.distances
+            "sensors" - between every receiver and transmitter, number of receivers x number of transmitters
+            "grids"   - between every grid and transmitter, number of grids x number of transmitters
+            "offsets" - between two grids as a function of their (row, column) offset, m x m
+        """
+        if name not in self.distances:
+            if name == "sensors":
+                self.distances[name] = DOIUtils.get_sensor_distances(self.config)
+            elif name == "grids":
+                self.distances[name] = DOIUtils.get_sensor_grid_distances("forward", config=self.config)
+            elif name == "offsets":
+                self.distances[name] = DOIUtils.get_offset_distances("forward", self.config)
+            else:
+                raise ValueError("Invalid distance name, input should be 'sensors', 'grids' or 'offsets'")
+        return self.distances[name]
+
     def get_direct_field(self):
         """
         Field from transmitter to receiver
         Output dimension - number of transmitters x number of receivers
         Does not change with scatterer
         """
-        receiver_x = [pos[0] for pos in MethodOfMomentModel.sensor_positions]
-        receiver_y = [pos[1] for pos in MethodOfMomentModel.sensor_positions]
-        transmitter_x = [pos[0] for pos in MethodOfMomentModel.sensor_positions]
-        transmitter_y = [pos[1] for pos in MethodOfMomentModel.sensor_positions]
+        self.direct_field = OperatorCache.load("direct_field", None, self.compute_direct_field, config=self.config)
 
-        [xtd, xrd] = np.meshgrid(transmitter_x, receiver_x)
-        [ytd, yrd] = np.meshgrid(transmitter_y, receiver_y)
-        dist = np.sqrt((xtd - xrd)**2 + (ytd - yrd)**2)
-        self.direct_field = (1j/4) * hankel1(0, MethodOfMomentModel.wave_number * dist)
+    def compute_direct_field(self):
+        dist = self.get_distances("sensors")
+        direct_field = (1j/4) * hankel1(0, self.wave_number * dist)
+        return direct_field
 
     def get_incident_field(self):
         """
@@ -74,20 +113,13 @@ class MethodOfMomentModel:
         Output dimension - number of transmitters x number of grids
         Does not change with scatterer
         """
-        transmitter_x = [pos[0] for pos in MethodOfMomentModel.sensor_positions]
-        transmitter_y = [pos[1] for pos in MethodOfMomentModel.sensor_positions]
-
-        grid_x = MethodOfMomentModel.grid_positions[0]
-        grid_x = grid_x.reshape(grid_x.size, order='F')
+        self.incident_field = OperatorCache.load("incident_field", "forward", self.compute_incident_field,
+                                                config=self.config)
 
-        grid_y = MethodOfMomentModel.grid_positions[1]
-        grid_y = grid_y.reshape(grid_y.size, order='F')
-
-        [xti, xsi] = np.meshgrid(transmitter_x, grid_x)
-        [yti, ysi] = np.meshgrid(transmitter_y, grid_y)
-
-        dist = np.sqrt((xti - xsi)**2 + (yti - ysi)**2)
-        self.incident_field = (1j/4) * hankel1(0, MethodOfMomentModel.wave_number * dist)
+    def compute_incident_field(self):
+        dist = self.get_distances("grids")
+        incident_field = (1j/4) * hankel1(0, self.wave_number * dist)
+        return incident_field
 
     def find_grids_with_object(self):
         # Unroll all grid numbers into one array, return the grid numbers that contain objects
@@ -95,71 +127,115 @@ class MethodOfMomentModel:
         self.object_grid_indices = np.nonzero(self.unrolled_permittivities != 1)
         self.object_grid_indices = self.object_grid_indices[0]
 
+    def get_offset_hankel_table(self):
+        """
+        hankel1(0, k*d) for every integer (row, column) offset between two grids of the uniform DOI
+        Output dimension - m x m, entry [0, 0] (self term) is left as zero
+        """
+        return OperatorCache.load("offset_hankel_table", "forward", self.compute_offset_hankel_table,
+                                  config=self.config)
+
+    def compute_offset_hankel_table(self):
+        dist = self.get_distances("offsets")
+        table = hankel1(0, self.wave_number * np.where(dist == 0, 1, dist))
+        table[0, 0] = 0
+        return table
+
     def get_field_from_scattering(self):
         """ Object field is a 2D array that captures the field on every point scatterer
         due to every other point scatterer """
 
-        Z = np.zeros((len(self.object_grid_indices), len(self.object_grid_indices)), dtype=np.complex64)
-        unroll_x = MethodOfMomentModel.grid_positions[0].reshape(MethodOfMomentModel.grid_positions[0].size, order='F')
-        unroll_y = MethodOfMomentModel.grid_positions[1].reshape(MethodOfMomentModel.grid_positions[1].size, order='F')
-        x_obj = unroll_x[self.object_grid_indices]
-        y_obj = unroll_y[self.object_grid_indices]
+        m = self.m
+        n = len(self.object_grid_indices)
+        Z = np.zeros((n, n), dtype=self.dtype)
 
-        for index, value in enumerate(self.object_grid_indices):
-            x_incident = x_obj[index]
-            y_incident = y_obj[index]
+        # Distance between two grids only depends on their offset, so gather Z from the offset table
+        table = (self.C1 * self.C2 * self.get_offset_hankel_table()).ravel()
+        rows = self.object_grid_indices % m
+        cols = self.object_grid_indices // m
 
-            dipole_distances = np.sqrt((x_incident - x_obj) ** 2 + (y_incident - y_obj) ** 2)
+        # Z is symmetric, fill the upper triangle one block of rows at a time and mirror it
+        block = 256
+        for start in range(0, n, block):
+            stop = min(start + block, n)
+            offsets = np.abs(rows[start:stop, None] - rows[None, start:]) * m + np.abs(cols[start:stop, None] - cols[None, start:])
+            Z[start:stop, start:] = table[offsets]
+            Z[stop:, start:stop] = Z[start:stop, stop:].T
 
-            a1 = hankel1(0, MethodOfMomentModel.wave_number * dipole_distances)
-            b1 = MethodOfMomentModel.impedance * self.unrolled_permittivities[value] / (MethodOfMomentModel.wave_number * (self.unrolled_permittivities[value] - 1))
+        Z[np.diag_indices(n)] = self.get_self_impedance(self.object_grid_indices)
 
-            z1 = MethodOfMomentModel.C1 * MethodOfMomentModel.C2 * a1
-            z1[index] = MethodOfMomentModel.C1 * MethodOfMomentModel.C3 - 1j * b1
+        return Z
 
-            assert len(z1) == len(dipole_distances)
-            Z[index, :] = z1
+    def get_self_impedance(self, grid_indices):
+        """ Diagonal entries of the impedance matrix for the given grids, depend on their permittivity """
+        permittivities = self.unrolled_permittivities[grid_indices]
+        b1 = self.impedance * permittivities / (self.wave_number * (permittivities - 1))
+        return self.C1 * self.C3 - 1j * b1
 
-        return Z
+    def get_mutual_impedance(self, row_indices, col_indices):
+        """
+        Block of the impedance matrix between two sets of grids, without the self terms
+        Output dimension - len(row_indices) x len(col_indices)
+        """
+        m = self.m
+        table = self.C1 * self.C2 * self.get_offset_hankel_table()
+        offsets_row = np.abs(row_indices[:, None] % m - col_indices[None, :] % m)
+        offsets_col = np.abs(row_indices[:, None] // m - col_indices[None, :] // m)
+        return table[offsets_row, offsets_col].astype(self.dtype)
 
     def get_induced_current(self, object_field):
         # Only consider that part of incident field which falls on grids containing object
-        self.get_incident_field()
-        incident_field_on_object = - self.incident_field[self.object_grid_indices]
-
-        J1 = np.linalg.inv(object_field) @ incident_field_on_object
-
-        current = np.zeros((MethodOfMomentModel.m**2, MethodOfMomentModel.tx_count), dtype=complex)
-        for i in range(len(self.object_grid_indices)):
-            current[self.object_grid_indices[i], :] = J1[i, :]
-
-        return current
-
-    @staticmethod
-    def get_scattered_field(current):
-
-        transmitter_x = [pos[0] for pos in MethodOfMomentModel.sensor_positions]
-        transmitter_y = [pos[1] for pos in MethodOfMomentModel.sensor_positions]
-
-        grid_x = MethodOfMomentModel.grid_positions[0]
-        grid_x = grid_x.reshape(grid_x.size, order='F')
+        with self.profiler.stage("incident_field"):
+            self.get_incident_field()
+            incident_field_on_object = - self.incident_field[self.object_grid_indices].astype(self.dtype)
+
+        # Factorize once, then solve for all transmitters together
+        with self.profiler.stage("current_solve"):
+            lu_piv = lu_factor(object_field, check_finite=False)
+            J1 = lu_solve(lu_piv, incident_field_on_object, check_finite=False)
+        self.profiler.record_arrays(impedance_matrix=object_field, current_on_object=J1)
+        norm = np.linalg.norm(incident_field_on_object)
+        # Without object there is no current to solve for
+        self.residual = np.linalg.norm(object_field @ J1 - incident_field_on_object) / norm if norm else 0.0
+
+        return J1
+
+    def get_scattered_field(self, current):
+        """
+        Field at every receiver due to the current induced on the grids containing object
+        current is only defined on self.object_grid_indices, the current on the remaining grids is zero
+        Output dimension - number of receivers x number of transmitters
+        """
+        if self.config.cache["enabled"]:
+            ZZ = self.get_receiver_greens()[:, self.object_grid_indices]
+        else:
+            ZZ = self.compute_receiver_greens(self.object_grid_indices)
+        scattered_field = ZZ @ current
 
-        grid_y = MethodOfMomentModel.grid_positions[1]
-        grid_y = grid_y.reshape(grid_y.size, order='F')
+        return scattered_field
 
-        [xts, xss] = np.meshgrid(transmitter_x, grid_x)
-        [yts, yss] = np.meshgrid(transmitter_y, grid_y)
+    def get_receiver_greens(self):
+        """
+        Field at every receiver due to unit current on every grid
+        Output dimension - number of receivers x number of grids
+        Does not change with scatterer
+        """
+        return OperatorCache.load("receiver_greens", "forward", self.compute_receiver_greens, config=self.config)
 
-        dist = np.sqrt((xts - xss)**2 + (yts - yss)**2)
-        ZZ = - MethodOfMomentModel.impedance * np.pi * (MethodOfMomentModel.grid_radius/2) * \
-             bessel1(1, MethodOfMomentModel.wave_number * MethodOfMomentModel.grid_radius) * \
-             hankel1(0, MethodOfMomentModel.wave_number * np.transpose(dist))
-        scattered_field = ZZ @ current
+    def compute_receiver_greens(self, grid_indices=None):
+        """ Receiver Green's function restricted to the columns of grid_indices, all grids when None """
+        dist = self.get_distances("grids")
+        if grid_indices is not None:
+            dist = dist[grid_indices]
 
-        return scattered_field
+        ZZ = - self.impedance * np.pi * (self.grid_radius/2) * \
+             bessel1(1, self.wave_number * self.grid_radius) * \
+             hankel1(0, self.wave_number * np.transpose(dist))
+        return ZZ
 
     def remove_nan_values(self, field):
         if self.nan_remove:
+            field = np.array(field)     # Cached operators are read-only
             np.fill_diagonal(field, np.nan)
             k = field.reshape(field.size, order='F')
             l = [x for x in k if not np.isnan(x)]
@@ -176,8 +252,7 @@ class MethodOfMomentModel:
             self.scattered_field = self.remove_nan_values(self.scattered_field)
             self.total_field = self.remove_nan_values(self.total_field)
 
-    @staticmethod
-    def get_power_from_field(field):
-        power = (np.abs(field)**2) * (MethodOfMomentModel.wavelength**2) / (4*np.pi*MethodOfMomentModel.impedance)
+    def get_power_from_field(self, field):
+        power = (np.abs(field)**2) * (self.wavelength**2) / (4*np.pi*self.impedance)
         power = 10 * np.log10(power / 1e-3)
         return power
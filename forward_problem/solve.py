@@ -1,39 +1,83 @@
 import os
 import sys
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.io import savemat
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from config import Config
+from config import Config, Configuration
 from utils.doi_utils import DOIUtils
+from utils.profile_utils import Profiler
+from utils.store_utils import DatasetStore
 
 from forward_problem.model import MethodOfMomentModel
+from forward_problem.fft_model import FFTMethodOfMomentModel
+from forward_problem.incremental import IncrementalMethodOfMomentModel
 
 
 class ForwardProblemSolver:
 
-    transceiver = Config.sensors["transceivers"]
-    rx_count = Config.sensors["count"]
-    tx_count = Config.sensors["count"]
-    sensor_positions = Config.sensors["positions"]
     nan_remove = True
 
-    def __init__(self, scatterer):
+    def __init__(self, scatterer, engine="mom", params=None, profile=None, config=None):
 
         # Solver input
         self.scatterer = scatterer
+        self.engine = engine
+        self.params = params if params is not None else {}
+        # Frequency, DOI and sensors, a Configuration or Config if None
+        self.config = config if config is not None else Config
+        # Per-stage timing and memory, enabled by profile=True or the ISP_PROFILE environment variable
+        self.profiler = Profiler(profile)
         # Forward model
-        self.model = MethodOfMomentModel(scatterer)
+        self.model = self.get_model()
+
+    def get_model(self):
+        """
+        "mom": dense Method of Moments, LU factorization of the impedance matrix solved for all transmitters at once
+        "fft": matrix-free Method of Moments, Krylov solver with FFT convolution,
+               params may contain "method" ("bicgstab" or "gmres"), "tolerance" and "max_iter"
+        "incremental": dense Method of Moments keeping the inverse impedance matrix between scatterers,
+               see update_scatterer, params may contain "max_update_fraction" and "refresh_every"
+        All engines accept "precision" ("single" or "double", the default) in params, "single" halves the memory of
+        the impedance matrix and its factorization, see MethodOfMomentModel.precision
+        """
+        if self.engine == "mom":
+            model = MethodOfMomentModel(self.scatterer, precision=self.params.get("precision"), config=self.config)
+        elif self.engine == "fft":
+            model = FFTMethodOfMomentModel(self.scatterer, method=self.params.get("method"),
+                                           tolerance=self.params.get("tolerance"),
+                                           max_iter=self.params.get("max_iter"),
+                                           precision=self.params.get("precision"), config=self.config)
+        elif self.engine == "incremental":
+            model = IncrementalMethodOfMomentModel(self.scatterer, precision=self.params.get("precision"),
+                                                   max_update_fraction=self.params.get("max_update_fraction"),
+                                                   refresh_every=self.params.get("refresh_every"),
+                                                   config=self.config)
+        else:
+            raise ValueError("Incorrect engine name, input should be 'mom', 'fft' or 'incremental'")
+        model.profiler = self.profiler
+        return model
+
+    def update_scatterer(self, scatterer):
+        """
+        Replaces the scatterer before the next call to generate_forward_data
+        The "incremental" engine reuses its previous solution, other engines start from scratch
+        """
+        self.scatterer = scatterer
+        if self.engine == "incremental":
+            self.model.update_scatterer(scatterer)
+        else:
+            self.model = self.get_model()
 
     @staticmethod
     def remove_nan_values(field):
+        """ Drops the diagonal (a transceiver measuring itself) of an rx x tx field, giving rx - 1 x tx """
         if ForwardProblemSolver.nan_remove:
+            field = np.array(field)     # Cached operators are read-only
             np.fill_diagonal(field, np.nan)
             k = field.reshape(field.size, order='F')
             l = [x for x in k if not np.isnan(x)]
-            m = np.reshape(l, (ForwardProblemSolver.tx_count, ForwardProblemSolver.rx_count - 1))
+            m = np.reshape(l, (field.shape[1], field.shape[0] - 1))
             m = np.transpose(m)
             return m
         if not ForwardProblemSolver.nan_remove:
@@ -41,49 +85,100 @@ class ForwardProblemSolver:
             return field
 
     def scatterer_independent_data(self):
-        self.model.get_direct_field()
-        direct_field = self.model.direct_field
-        direct_field = ForwardProblemSolver.remove_nan_values(direct_field)
-        direct_power = self.model.get_power_from_field(direct_field)
+        with self.profiler.stage("direct_field"):
+            self.model.get_direct_field()
+            direct_field = self.model.direct_field
+        with self.profiler.stage("remove_nan_values"):
+            direct_field = ForwardProblemSolver.remove_nan_values(direct_field)
+        with self.profiler.stage("direct_power"):
+            direct_power = self.model.get_power_from_field(direct_field)
         return direct_field, direct_power
 
     def scattered_field_at_rx(self):
-        self.model.find_grids_with_object()
-        object_field = self.model.get_field_from_scattering()
+        with self.profiler.stage("find_grids_with_object"):
+            self.model.find_grids_with_object()
+        with self.profiler.stage("impedance_assembly"):
+            object_field = self.model.get_field_from_scattering()
+        self.profiler.record_arrays(object_grid_indices=self.model.object_grid_indices)
         current = self.model.get_induced_current(object_field)
-        scattered_field = self.model.get_scattered_field(current)
-        scattered_field = ForwardProblemSolver.remove_nan_values(scattered_field)
+        with self.profiler.stage("scattered_field"):
+            scattered_field = self.model.get_scattered_field(current)
+        self.profiler.record_arrays(current=current, scattered_field=scattered_field)
+        with self.profiler.stage("remove_nan_values"):
+            scattered_field = ForwardProblemSolver.remove_nan_values(scattered_field)
         return scattered_field
 
     def scatterer_dependent_data(self, direct_field):
         scattered_field = self.scattered_field_at_rx()
-        total_field = direct_field + scattered_field
-        total_power = self.model.get_power_from_field(total_field)
+        with self.profiler.stage("total_power"):
+            total_field = direct_field + scattered_field
+            total_power = self.model.get_power_from_field(total_field)
         return scattered_field, total_field, total_power
 
     def generate_forward_data(self):
+        self.profiler.reset()
         direct_field, direct_power = self.scatterer_independent_data()
         scattered_field, total_field, total_power = self.scatterer_dependent_data(direct_field)
+        self.profiler.emit(f"forward_{self.engine}")
         return direct_field, direct_power, scattered_field, total_field, total_power
 
+    def generate_wideband_data(self, frequencies):
+        """
+        Forward data at every frequency of frequencies, outputs as of generate_forward_data stacked along a last
+        frequency axis, e.g. total_power of dimension rx x tx x number of frequencies
+        The models of all frequencies share the distance matrices of self.model, only the frequency dependent
+        Hankel and Bessel terms and the current solve are computed for every frequency
+        """
+        self.profiler.reset()
+        base = Configuration.from_config(self.config)
+        outputs = []
+        for frequency in frequencies:
+            solver = ForwardProblemSolver(self.scatterer, self.engine, self.params,
+                                          config=base.replace(system={"frequency": frequency}))
+            solver.profiler = solver.model.profiler = self.profiler
+            solver.model.distances = self.model.distances
+            with self.profiler.stage(f"frequency_{frequency:g}"):
+                direct_field, direct_power = solver.scatterer_independent_data()
+                outputs.append((direct_field, direct_power) + solver.scatterer_dependent_data(direct_field))
+        self.profiler.emit(f"forward_wideband_{self.engine}")
+        return tuple(np.stack(arrays, axis=-1) for arrays in zip(*outputs))
+
     @staticmethod
-    def get_field_plots(total_field, direct_field, scattered_field, tx_num):
-        plt.figure()
-        plt.plot(range(ForwardProblemSolver.rx_count - 1), np.abs(total_field[:, tx_num]), label="Total Field")
-        plt.plot(range(ForwardProblemSolver.rx_count - 1), np.abs(direct_field[:, tx_num]), label="Incident Field")
-        plt.plot(range(ForwardProblemSolver.rx_count - 1), np.abs(scattered_field[:, tx_num]), label="Scattered Field")
+    def get_field_plots(total_field, direct_field, scattered_field, tx_num, path=None):
+        """ Field magnitudes at the receivers for transmitter tx_num, saved to path if given, shown otherwise """
+        # Imported here so that solving never requires matplotlib
+        import matplotlib.pyplot as plt
+
+        figure = plt.figure()
+        plt.plot(range(total_field.shape[0]), np.abs(total_field[:, tx_num]), label="Total Field")
+        plt.plot(range(total_field.shape[0]), np.abs(direct_field[:, tx_num]), label="Incident Field")
+        plt.plot(range(total_field.shape[0]), np.abs(scattered_field[:, tx_num]), label="Scattered Field")
         plt.axis([0, 40, 0, 0.06])
         plt.legend()
-        plt.show()
+        if path is None:
+            plt.show()
+        else:
+            figure.savefig(path)
+            plt.close(figure)
 
     @staticmethod
-    def save_data(scatterer, direct_field, direct_power, scattered_field, total_field, total_power):
-        savemat('data/scatterer.mat', {"scatterer": scatterer})
-        savemat('data/direct_field.mat', {"direct_field": direct_field})
-        savemat('data/direct_power.mat', {"direct_power": direct_power})
-        savemat('data/scattered_field.mat', {"scattered_field": scattered_field})
-        savemat('data/total_field.mat', {"total_field": total_field})
-        savemat('data/total_power.mat', {"total_power": total_power})
+    def save_data(scatterer, direct_field, direct_power, scattered_field, total_field, total_power, path="data/store",
+                  config=None, frequencies=None):
+        """
+        Appends the forward data of one scatterer as a new sample of the dataset store at path
+        The scatterer independent direct field and power are stored once, with the configuration as attributes
+        and, for the output of generate_wideband_data, the frequencies of its last axis
+        """
+        store = DatasetStore(path)
+        if "direct_field" not in store:
+            store.set_attributes(config=DatasetStore.get_config_attributes(config))
+            if frequencies is not None:
+                store.set_attributes(frequencies=list(frequencies))
+            store.put("direct_field", direct_field)
+            store.put("direct_power", direct_power)
+        store.append(scatterer=scatterer, scattered_field=scattered_field, total_field=total_field,
+                     total_power=total_power)
+        return store
 
 
 if __name__ == '__main__':
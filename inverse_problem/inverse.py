@@ -8,47 +8,66 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from config import Config
 from utils.doi_utils import DOIUtils
+from utils.cache_utils import OperatorCache
 
 
 class LinearInverse:
 
-    def __init__(self):
+    def __init__(self, grids=None, config=None):
+        """
+        grids - number of inverse grids along one side of the DOI, config.doi["inverse_grids"] if None
+        config - Configuration of the frequency, DOI and sensors, Config if None
+        """
+        self.config = config if config is not None else Config
 
         # System parameters
-        self.frequency = Config.system["frequency"]
+        self.frequency = self.config.system["frequency"]
         self.wavelength = 3e8 / self.frequency
         self.wave_number = 2*np.pi / self.wavelength
         self.impedance = 120*np.pi
 
         # Room parameters
-        self.m = Config.doi["inverse_grids"]
+        self.m = DOIUtils.get_grid_count("inverse", grids, self.config)
         self.number_of_grids = self.m ** 2
-        self.grid_positions = DOIUtils.get_grid_centroids("inverse")
-        self.grid_radius = DOIUtils.get_grid_radius("inverse")
+        self.grid_positions = DOIUtils.get_grid_centroids("inverse", self.m, self.config)
+        self.grid_radius = DOIUtils.get_grid_radius("inverse", self.m, self.config)
 
         # Sensor parameters
-        self.transceiver = Config.sensors["transceivers"]
-        self.number_of_rx = Config.sensors["count"]
-        self.number_of_tx = Config.sensors["count"]
-        self.sensor_positions = Config.sensors["positions"]
+        self.transceiver = self.config.sensors["transceivers"]
+        self.number_of_rx = self.config.sensors["count"]
+        self.number_of_tx = self.config.sensors["count"]
+        self.sensor_positions = self.config.sensors["positions"]
 
         self.nan_remove = True
         self.noise_level = 0
 
+        # Frequency independent distances, see get_distances, the models of a wideband solve share one dictionary
+        self.distances = {}
+
+    def get_distances(self, name):
+        """
+        Distance matrix computed on first use and kept in self.distances
+            "sensors" - between every receiver and transmitter, number of receivers x number of transmitters
+            "grids"   - between every grid and transmitter, number of grids x number of transmitters
+        """
+        if name not in self.distances:
+            if name == "sensors":
+                self.distances[name] = DOIUtils.get_sensor_distances(self.config)
+            elif name == "grids":
+                self.distances[name] = DOIUtils.get_sensor_grid_distances("inverse", self.m, self.config)
+            else:
+                raise ValueError("Invalid distance name, input should be 'sensors' or 'grids'")
+        return self.distances[name]
+
     def get_direct_field(self):
         """
         Field from transmitter to receiver
         Output dimension - number of transmitters x number of receivers
         """
-        receiver_x = [pos[0] for pos in self.sensor_positions]
-        receiver_y = [pos[1] for pos in self.sensor_positions]
+        return OperatorCache.load("direct_field", None, self.compute_direct_field, config=self.config)
 
-        transmitter_x = [pos[0] for pos in self.sensor_positions]
-        transmitter_y = [pos[1] for pos in self.sensor_positions]
-
-        [xtd, xrd] = np.meshgrid(transmitter_x, receiver_x)
-        [ytd, yrd] = np.meshgrid(transmitter_y, receiver_y)
-        dist = np.sqrt((xtd - xrd) ** 2 + (ytd - yrd) ** 2)
+    def compute_direct_field(self):
+        dist = self.get_distances("sensors")
         direct_field = (1j / 4) * hankel1(0, self.wave_number * dist)
         return direct_field
 
@@ -57,36 +76,22 @@ class LinearInverse:
         Field from transmitter on every incident grid
         Output dimension - number of transmitters x number of grids
         """
-        transmitter_x = [pos[0] for pos in self.sensor_positions]
-        transmitter_y = [pos[1] for pos in self.sensor_positions]
-
-        grid_x = self.grid_positions[0]
-        grid_x = grid_x.reshape(grid_x.size, order='F')
+        return OperatorCache.load("incident_field", "inverse", self.compute_incident_field, self.m, self.config)
 
-        grid_y = self.grid_positions[1]
-        grid_y = grid_y.reshape(grid_y.size, order='F')
-
-        [xti, xsi] = np.meshgrid(transmitter_x, grid_x)
-        [yti, ysi] = np.meshgrid(transmitter_y, grid_y)
-
-        dist = np.sqrt((xti - xsi)**2 + (yti - ysi)**2)
+    def compute_incident_field(self):
+        dist = self.get_distances("grids")
         incident_field = (1j/4) * hankel1(0, self.wave_number * dist)
         return incident_field
 
     def get_greens_integral(self):
-        transmitter_x = [pos[0] for pos in self.sensor_positions]
-        transmitter_y = [pos[1] for pos in self.sensor_positions]
-
-        grid_x = self.grid_positions[0]
-        grid_x = grid_x.reshape(grid_x.size, order='F')
-
-        grid_y = self.grid_positions[1]
-        grid_y = grid_y.reshape(grid_y.size, order='F')
-
-        [xtg, xsg] = np.meshgrid(transmitter_x, grid_x)
-        [ytg, ysg] = np.meshgrid(transmitter_y, grid_y)
+        """
+        Integral of the Green's function over every grid, observed at every receiver
+        Output dimension - number of receivers x number of grids
+        """
+        return OperatorCache.load("greens_integral", "inverse", self.compute_greens_integral, self.m, self.config)
 
-        dist = np.sqrt((xtg - xsg)**2 + (ytg - ysg)**2)
+    def compute_greens_integral(self):
+        dist = self.get_distances("grids")
         integral = (1j * np.pi * self.grid_radius / (2 * self.wave_number)) * \
             bessel1(1, self.wave_number * self.grid_radius) * hankel1(0, self.wave_number * np.transpose(dist))
         return integral
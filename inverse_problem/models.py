@@ -2,6 +2,7 @@
 import os
 import sys
 import numpy as np
+from scipy.sparse.linalg import LinearOperator
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
@@ -10,23 +11,25 @@ from config import Config
 
 class Model:
 
-    def __init__(self):
+    def __init__(self, config=None):
+        """ config - Configuration of the frequency, DOI and sensors, Config if None """
+        self.config = config if config is not None else Config
 
         # Physical parameters
-        self.frequency = Config.system["frequency"]
+        self.frequency = self.config.system["frequency"]
         self.wavelength = 3e8 / self.frequency
         self.wave_number = 2 * np.pi / self.wavelength
 
         # Room parameters
-        self.m = Config.doi["inverse_grids"]
+        self.m = self.config.doi["inverse_grids"]
         self.number_of_grids = self.m ** 2
 
         # Sensor parameters
-        self.transceiver = Config.sensors["transceivers"]
-        self.number_of_rx = Config.sensors["count"]
-        self.number_of_tx = Config.sensors["count"]
-        self.sensor_positions = Config.sensors["positions"]
-        self.sensor_links = Config.sensors["links"]
+        self.transceiver = self.config.sensors["transceivers"]
+        self.number_of_rx = self.config.sensors["count"]
+        self.number_of_tx = self.config.sensors["count"]
+        self.sensor_positions = self.config.sensors["positions"]
+        self.sensor_links = self.config.sensors["links"]
 
         # Other parameters
         self.nan_remove = True
@@ -40,45 +43,106 @@ class Model:
 
 class PRytov(Model):
 
-    def get_model(self, direct_field, incident_field, integral_values):
-        A = np.zeros((len(self.sensor_links), self.number_of_grids), dtype=complex)
-        for i, pair in enumerate(self.sensor_links):
-            A[i, :] = np.real(self.wave_number ** 2
-                              * np.divide(np.multiply(integral_values[pair[1], :],
-                                                      np.transpose(incident_field[:, pair[0]])),
-                                          direct_field[pair[1], pair[0]]))
+    def get_rytov_kernel(self, direct_field, incident_field, integral_values):
+        """
+        Complex Rytov kernel shared by all PRytov models, one row per sensor link
+        Row of link (tx, rx) is k^2 * integral_values[rx, :] * incident_field[:, tx] / direct_field[rx, tx]
+        Output dimension - number of links x number of grids
+        """
+        links = np.asarray(self.sensor_links)
+        tx, rx = links[:, 0], links[:, 1]
+
+        A = integral_values[rx, :]
+        A *= np.transpose(incident_field[:, tx])
+        A *= (self.wave_number ** 2 / direct_field[rx, tx])[:, None]
         return A
 
+    def get_rytov_products(self, direct_field, incident_field, integral_values):
+        """
+        Products with the complex Rytov kernel K that never form it, memory is linear in links + grids
+        K @ x    - k^2 / direct_field[rx, tx] * (integral_values @ (x * incident_field))[rx, tx] for every link
+        K.T @ w  - sum over tx of (integral_values.T @ W) * incident_field, W holding k^2 w / direct_field at the links
+        """
+        links = np.asarray(self.sensor_links)
+        tx, rx = links[:, 0], links[:, 1]
+        scale = self.wave_number ** 2 / direct_field[rx, tx]
+        incident_field = np.asarray(incident_field)
+        integral_values = np.asarray(integral_values)
+        shape = (integral_values.shape[0], incident_field.shape[1])
+
+        def forward(x):
+            return scale * (integral_values @ (x[:, None] * incident_field))[rx, tx]
+
+        def transpose(w):
+            weights = np.zeros(shape, dtype=complex)
+            weights[rx, tx] = scale * w
+            return np.sum((integral_values.T @ weights) * incident_field, axis=1)
+
+        return forward, transpose
+
+    def get_operator(self, direct_field, incident_field, integral_values):
+        """ Matrix-free version of get_model, as a scipy LinearOperator """
+        forward, transpose = self.get_rytov_products(direct_field, incident_field, integral_values)
+        shape = (len(self.sensor_links), incident_field.shape[0])
+        return LinearOperator(shape, matvec=lambda x: forward(np.ravel(x)).real,
+                              rmatvec=lambda w: transpose(np.ravel(w)).real, dtype=float)
+
+    def get_model(self, direct_field, incident_field, integral_values):
+        A = self.get_rytov_kernel(direct_field, incident_field, integral_values)
+        return np.ascontiguousarray(A.real)
+
     @staticmethod
     def get_data(total_power, direct_power):
+        """
+        Rytov data of one frame as a vector, or of a stack of frames (total_power of shape rx x tx x frames)
+        as a links x frames matrix, direct_power is shared by all frames unless it is stacked as well
+        """
+        if total_power.ndim == 3 and direct_power.ndim == 2:
+            direct_power = direct_power[:, :, None]
         data = (total_power - direct_power) / (10 * np.log10(np.exp(2)))
-        data = data.reshape(data.size, order='F')
+        if data.ndim == 3:
+            data = data.reshape((-1, data.shape[2]), order='F')
+        else:
+            data = data.reshape(data.size, order='F')
         return data
 
 
 class PRytovComplex(PRytov):
 
     def get_model(self, direct_field, incident_field, integral_values):
-        A = np.zeros((len(self.sensor_links), self.number_of_grids), dtype=complex)
-        for i, pair in enumerate(self.sensor_links):
-            A[i, :] = (self.wave_number ** 2) * np.divide(np.multiply(integral_values[pair[1], :],
-                                                                      np.transpose(incident_field[:, pair[0]])),
-                                                          direct_field[pair[1], pair[0]])
-
-        A_real = np.real(A)
-        A_imag = np.imag(A)
-        A_final = np.concatenate((A_real, -A_imag), axis=1)
+        A = self.get_rytov_kernel(direct_field, incident_field, integral_values)
+
+        number_of_grids = A.shape[1]
+        A_final = np.empty((A.shape[0], 2 * number_of_grids))
+        A_final[:, :number_of_grids] = A.real
+        A_final[:, number_of_grids:] = -A.imag
         return A_final
 
+    def get_operator(self, direct_field, incident_field, integral_values):
+        """ [Re K, -Im K] @ [x_real; x_imag] is Re(K @ (x_real + 1j * x_imag)) """
+        forward, transpose = self.get_rytov_products(direct_field, incident_field, integral_values)
+        number_of_grids = incident_field.shape[0]
+
+        def matvec(x):
+            x = np.ravel(x)
+            return forward(x[:number_of_grids] + 1j * x[number_of_grids:]).real
+
+        def rmatvec(w):
+            product = transpose(np.ravel(w))
+            return np.concatenate((product.real, -product.imag))
+
+        shape = (len(self.sensor_links), 2 * number_of_grids)
+        return LinearOperator(shape, matvec=matvec, rmatvec=rmatvec, dtype=float)
+
 
 class PRytovImag(PRytov):
 
     def get_model(self, direct_field, incident_field, integral_values):
-        A = np.zeros((len(self.sensor_links), self.number_of_grids), dtype=complex)
-        for i, pair in enumerate(self.sensor_links):
-            A[i, :] = (self.wave_number ** 2) * np.divide(np.multiply(integral_values[pair[1], :],
-                                                                      np.transpose(incident_field[:, pair[0]])),
-                                                          direct_field[pair[1], pair[0]])
-
-        A_imag = np.imag(A)
-        return -A_imag
+        A = self.get_rytov_kernel(direct_field, incident_field, integral_values)
+        return -A.imag
+
+    def get_operator(self, direct_field, incident_field, integral_values):
+        forward, transpose = self.get_rytov_products(direct_field, incident_field, integral_values)
+        shape = (len(self.sensor_links), incident_field.shape[0])
+        return LinearOperator(shape, matvec=lambda x: -forward(np.ravel(x)).imag,
+                              rmatvec=lambda w: -transpose(np.ravel(w)).imag, dtype=float)
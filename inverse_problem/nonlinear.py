@@ -0,0 +1,235 @@
+import os
+import sys
+import time
+import warnings
+import numpy as np
+from scipy.fft import fft2, ifft2, next_fast_len
+from scipy.special import jv as bessel1
+from scipy.special import hankel1
+from scipy.sparse.linalg import LinearOperator, gmres
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from config import Config
+from utils.doi_utils import DOIUtils
+from utils.cache_utils import OperatorCache
+from inverse_problem.inverse import LinearInverse
+from inverse_problem.models import PRytovComplex, PRytovImag
+from inverse_problem.solve import InverseProblemSolver
+from inverse_problem.regularize import Regularizer
+
+
+class DistortedBornSolver:
+    """
+    Nonlinear reconstruction by the distorted Born iterative method on the inverse grids
+    Every outer iteration solves the field equation E - k^2 G_D (chi E) = E_inc in the current reconstruction chi with
+    FFT accelerated GMRES, warm started from the fields of the previous iteration, and linearizes the log-amplitude data
+    around it: the PRytov model with the incident field, Green's integral and direct field replaced by the total fields
+    in chi (the receiver Green's functions follow from reciprocity, so sensors must be transceivers).
+    The prior then gives the next reconstruction from the linearized data, the step towards it is halved until the
+    Tikhonov objective decreases; the first reconstruction is the linear Rytov solution.
+    All scatterer independent operators come from OperatorCache, nothing is solved on the forward grids.
+    """
+
+    # Relative tolerance and iteration limit of the GMRES field solves
+    field_tolerance = 1e-6
+    field_max_iter = 100
+    # Number of times the step of an outer iteration is halved before the iterations stop
+    max_backtracking = 5
+
+    def __init__(self, direct_power, total_power, model_name, prior, params, max_iter=10, tol=1e-3, profile=None,
+                 config=None):
+        """
+        :param direct_power: direct power without any scatterer
+        :param total_power: total power of a single frame
+        :param model_name: "prytov" (real contrast), "prytov_complex" or "prytov_imag" (imaginary contrast)
+        :param prior: "ridge" or "qs2D"
+        :param params: parameters of the prior, as for InverseProblemSolver
+        :param max_iter: maximum number of outer iterations
+        :param tol: iterations stop once the relative change of the reconstruction falls below tol,
+                    or when no step along the Gauss-Newton direction decreases the objective
+        :param profile: enables per-stage timing and memory, as for InverseProblemSolver
+        :param config: Configuration of the frequency, DOI and sensors, Config if None
+        """
+        self.config = config if config is not None else Config
+        if not self.config.sensors["transceivers"]:
+            raise ValueError("Distorted Born iterations need transceivers, receiver Green's functions use reciprocity")
+        if prior not in ("ridge", "qs2D"):
+            raise ValueError("Distorted Born iterations are only available for 'ridge' and 'qs2D' priors")
+        if params.get("mask") is not None:
+            raise ValueError("Distorted Born iterations do not support a support mask")
+
+        self.solver = InverseProblemSolver(direct_power, total_power, model_name, prior, params, profile, self.config)
+        self.model_class = self.solver.get_model_class()
+        self.profiler = self.solver.profiler
+        self.max_iter = max_iter
+        self.tol = tol
+
+        inverse_problem = LinearInverse(config=self.config)
+        self.m = inverse_problem.m
+        self.wave_number = inverse_problem.wave_number
+        self.grid_radius = inverse_problem.grid_radius
+        self.direct_field = np.asarray(inverse_problem.get_direct_field())
+        self.incident_field = np.asarray(inverse_problem.get_incident_field())
+        self.integral_values = np.asarray(inverse_problem.get_greens_integral())
+        # Ratio of the Green's integral over a grid to the field of a point source at its centroid
+        self.integral_scale = 2 * np.pi * self.grid_radius * bessel1(1, self.wave_number * self.grid_radius) / self.wave_number
+        self.kernel_spectrum = self.get_kernel_spectrum()
+
+        self.fields = None      # Total field on every grid for every transmitter in the current reconstruction
+        self.history = []       # Per outer iteration: residual, objective, change, field solver iterations and seconds
+
+    def get_domain_greens_table(self):
+        """
+        k^2 times the Green's integral over a grid observed at the grid (di, dj) offsets away
+        Output dimension - m x m, entry [0, 0] is the self term
+        """
+        return OperatorCache.load("domain_greens_table", "inverse", self.compute_domain_greens_table,
+                                  config=self.config)
+
+    def compute_domain_greens_table(self):
+        ka = self.wave_number * self.grid_radius
+        dist = DOIUtils.get_offset_distances("inverse", self.config)
+        table = (1j * np.pi * ka / 2) * bessel1(1, ka) * hankel1(0, self.wave_number * np.where(dist == 0, 1, dist))
+        table[0, 0] = (1j * np.pi * ka / 2) * hankel1(1, ka) - 1
+        return table
+
+    def get_kernel_spectrum(self):
+        """ Spectrum of the circulant embedding of the block-Toeplitz operator k^2 G_D """
+        m = self.m
+        size = next_fast_len(2 * m - 1)
+        offsets = np.arange(size)
+        offsets = np.minimum(offsets, size - offsets)
+        valid = offsets < m
+
+        kernel = np.zeros((size, size), dtype=complex)
+        kernel[np.ix_(valid, valid)] = self.get_domain_greens_table()[np.ix_(offsets[valid], offsets[valid])]
+        return fft2(kernel)
+
+    def apply_greens(self, sources):
+        """ k^2 G_D @ sources for sources of dimension number of grids x columns """
+        m = self.m
+        size = self.kernel_spectrum.shape[0]
+        images = sources.reshape((m, m, -1), order='F')
+        convolved = ifft2(self.kernel_spectrum[:, :, None] * fft2(images, s=(size, size), axes=(0, 1)), axes=(0, 1))
+        return convolved[:m, :m].reshape((m ** 2, -1), order='F')
+
+    def get_total_fields(self, chi):
+        """
+        Total field on every grid for every transmitter in the contrast chi, warm started from the previous fields
+        Output dimension - number of grids x number of transmitters, with the number of GMRES iterations
+        """
+        number_of_grids = self.m ** 2
+        operator = LinearOperator((number_of_grids, number_of_grids), dtype=complex,
+                                  matvec=lambda field: np.ravel(field) - self.apply_greens(chi * np.ravel(field))[:, 0])
+        fields = self.incident_field.copy() if self.fields is None else self.fields.copy()
+
+        iterations = 0
+        for tx in range(fields.shape[1]):
+            counter = []
+            fields[:, tx], info = gmres(operator, self.incident_field[:, tx], x0=fields[:, tx], rtol=self.field_tolerance,
+                                        restart=50, maxiter=self.field_max_iter, callback_type="pr_norm",
+                                        callback=lambda *args: counter.append(1))
+            iterations += len(counter)
+            if info > 0:
+                warnings.warn(f"Field solve did not converge for transmitter {tx} within {self.field_max_iter} iterations")
+        return fields, iterations
+
+    def get_receiver_fields(self, chi, fields):
+        """ Total field at every receiver for every transmitter, rx x tx """
+        return self.direct_field + self.wave_number ** 2 * (self.integral_values @ (chi[:, None] * fields))
+
+    def get_contrast(self, x):
+        """ Complex contrast of the unknowns of the model, see the PRytov models """
+        if isinstance(self.model_class, PRytovComplex):
+            return x[:self.m ** 2] + 1j * x[self.m ** 2:]
+        elif isinstance(self.model_class, PRytovImag):
+            return 1j * x
+        return x.astype(complex)
+
+    def get_linearized_model(self, receiver_fields, fields):
+        """ PRytov model around the current reconstruction, the receiver Green's functions are fields of the sensors """
+        distorted_integral = np.transpose(self.integral_scale * fields)
+        if self.solver.is_matrix_free():
+            return self.model_class.get_operator(receiver_fields, fields, distorted_integral)
+        return self.model_class.get_model(receiver_fields, fields, distorted_integral)
+
+    def get_prior(self, A):
+        """ Tikhonov matrix Q of the prior for the columns of A, None for the identity """
+        if self.solver.prior == "qs2D":
+            return Regularizer.get_smoothing(A, self.solver.params)
+        return None, None
+
+    def get_objective(self, residual, x, Q):
+        """ ||data - F(x)||^2 + alpha * x.T @ Q @ x, the quantity the line search decreases """
+        prior = x @ x if Q is None else x @ (Q @ x)
+        return residual @ residual + self.solver.params["alpha"] * prior
+
+    def evaluate(self, x, data):
+        """ Total fields, receiver fields and log-amplitude residual of the reconstruction x """
+        links = np.asarray(self.model_class.sensor_links)
+        tx, rx = links[:, 0], links[:, 1]
+        chi = self.get_contrast(x)
+        fields, iterations = self.get_total_fields(chi)
+        receiver_fields = self.get_receiver_fields(chi, fields)
+        residual = data - np.log(np.abs(receiver_fields[rx, tx] / self.direct_field[rx, tx]))
+        return fields, receiver_fields, residual, iterations
+
+    def solve(self):
+        """ Reconstruction shaped like the output of InverseProblemSolver.solve, see self.history for convergence """
+        self.profiler.reset()
+        self.fields = None
+        self.history = []
+
+        data = self.solver.get_measurement_data()
+        if data.ndim != 1:
+            raise ValueError("Distorted Born iterations reconstruct a single frame")
+        params = self.solver.params
+
+        with self.profiler.stage("linear"):
+            A = self.solver.get_inverse_model()
+            Q, L = self.get_prior(A)
+            x = Regularizer.solve_tikhonov(A, data, params["alpha"], Q, L, params)
+        with self.profiler.stage("fields"):
+            self.fields, receiver_fields, residual, _ = self.evaluate(x, data)
+        objective = self.get_objective(residual, x, Q)
+
+        for iteration in range(1, self.max_iter + 1):
+            start = time.perf_counter()
+            with self.profiler.stage(f"iteration_{iteration}"):
+                with self.profiler.stage("linearize"):
+                    A = self.get_linearized_model(receiver_fields, self.fields)
+                with self.profiler.stage("regularizer"):
+                    # Solving for the new reconstruction rather than the update keeps the prior on the reconstruction
+                    step = Regularizer.solve_tikhonov(A, residual + A @ x, params["alpha"], Q, L, params) - x
+
+                # Backtracking on the Tikhonov objective, the full Gauss-Newton step can overshoot for strong scatterers
+                field_iterations = 0
+                with self.profiler.stage("line_search"):
+                    for _ in range(self.max_backtracking + 1):
+                        candidate = x + step
+                        fields, candidate_receiver_fields, candidate_residual, iterations = self.evaluate(candidate, data)
+                        field_iterations += iterations
+                        candidate_objective = self.get_objective(candidate_residual, candidate, Q)
+                        if candidate_objective < objective:
+                            break
+                        step = step / 2
+
+            accepted = candidate_objective < objective
+            change = np.linalg.norm(step) / max(np.linalg.norm(x), np.finfo(float).tiny) if accepted else 0.0
+            if accepted:
+                x, objective = candidate, candidate_objective
+                self.fields, receiver_fields, residual = fields, candidate_receiver_fields, candidate_residual
+            self.history.append({
+                "iteration": iteration,
+                "residual": float(np.linalg.norm(residual) / np.linalg.norm(data)),
+                "objective": float(objective),
+                "change": float(change),
+                "field_iterations": field_iterations,
+                "seconds": time.perf_counter() - start
+            })
+            if change < self.tol:
+                break
+
+        self.profiler.emit(f"inverse_distorted_born_{self.solver.model_name}_{self.solver.prior}")
+        return Regularizer._return_chi(x, A)
@@ -0,0 +1,261 @@
+import os
+import sys
+import time
+import numpy as np
+from scipy.linalg import cholesky, solve_triangular, svd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from inverse_problem.regularize import Regularizer
+
+
+class RegularizationPath:
+    """
+    Tikhonov solutions min ||data - A chi||^2 + alpha * chi.T @ Q @ chi for many values of alpha from one factorization
+    For Q = R.T @ R (Cholesky) the problem is brought to standard form with A_bar = A @ R^-1 and z = R @ chi,
+    the SVD of A_bar then plays the role of the GSVD of (A, R), every alpha costs only a diagonal rescaling
+    data may be a vector or a links x frames matrix, every frame then has its own residuals and selected alpha
+    """
+
+    def __init__(self, A, data, Q=None, mask=None):
+        self.A = A
+        self.data = data
+        self.mask = mask    # Support mask of the columns of A, see Regularizer._return_chi
+        self.stacked = np.ndim(data) == 2
+
+        if Q is None:
+            self.R = None
+            A_bar = A
+        else:
+            self.R = cholesky(Q.toarray(), lower=False)
+            A_bar = solve_triangular(self.R, A.T, trans='T', lower=False).T
+
+        self.U, self.s, self.Vt = svd(A_bar, full_matrices=False)
+        # One column per frame, a single column for a vector of data
+        self.beta = np.reshape(self.U.T @ data, (len(self.s), -1))
+        # Part of the data outside the range of A, no value of alpha can fit it
+        self.residual_outside = np.maximum(np.sum(np.reshape(data, (len(data), -1)) ** 2, axis=0) -
+                                           np.sum(self.beta ** 2, axis=0), 0)
+
+    def filter_factors(self, alphas):
+        alphas = np.atleast_1d(alphas)
+        s2 = self.s[:, None] ** 2
+        return s2 / (s2 + alphas[None, :])
+
+    def to_solution(self, z):
+        """ Solution chi from its standard form coefficients z, one per column """
+        if self.R is None:
+            return z
+        return solve_triangular(self.R, z, lower=False)
+
+    def solutions(self, alphas):
+        """
+        Solutions for every value of alphas
+        Output dimension - A.shape[1] x len(alphas), with a last axis of frames for a matrix of data
+        """
+        coefficients = self.filter_factors(alphas)[:, :, None] * (self.beta / self.s[:, None])[:, None, :]
+        z = self.to_solution(self.Vt.T @ np.reshape(coefficients, (len(self.s), -1)))
+        z = np.reshape(z, (z.shape[0],) + coefficients.shape[1:])
+        return z if self.stacked else z[:, :, 0]
+
+    def solution(self, alpha):
+        """ Solution for alpha, for a matrix of data alpha may also hold one value per frame as returned by select """
+        z = self.to_solution(self.Vt.T @ (self.filter_factors(alpha) * self.beta / self.s[:, None]))
+        return z if self.stacked else z[:, 0]
+
+    def reconstruction(self, alpha):
+        """ Solution for alpha reshaped like the output of the Regularizer priors """
+        return Regularizer._return_chi(self.solution(alpha), self.A, self.mask)
+
+    def per_frame(self, values):
+        """ Drops the frame axis of alphas x frames values for a vector of data """
+        return values if self.stacked else values[:, 0]
+
+    def residual_norms(self, alphas):
+        """ ||data - A chi|| for every value of alphas, len(alphas) x frames for a matrix of data """
+        residual = (1 - self.filter_factors(alphas))[:, :, None] * self.beta[:, None, :]
+        return self.per_frame(np.sqrt(np.sum(residual ** 2, axis=0) + self.residual_outside))
+
+    def solution_norms(self, alphas):
+        """ Seminorm sqrt(chi.T @ Q @ chi) for every value of alphas, len(alphas) x frames for a matrix of data """
+        z = self.filter_factors(alphas)[:, :, None] * (self.beta / self.s[:, None])[:, None, :]
+        return self.per_frame(np.sqrt(np.sum(z ** 2, axis=0)))
+
+    def gcv(self, alphas):
+        """ Generalized cross validation function, minimized by the selected alpha """
+        degrees_of_freedom = len(self.data) - np.sum(self.filter_factors(alphas), axis=0)
+        residual_norms = np.reshape(self.residual_norms(alphas), (len(degrees_of_freedom), -1))
+        return self.per_frame(residual_norms ** 2 / degrees_of_freedom[:, None] ** 2)
+
+    def lcurve_curvature(self, alphas):
+        """ Curvature of the (log residual norm, log solution norm) curve, largest in magnitude at the L-curve corner """
+        log_alphas = np.log(alphas)
+        x = np.log(self.residual_norms(alphas))
+        y = np.log(self.solution_norms(alphas))
+        dx, dy = np.gradient(x, log_alphas, axis=0), np.gradient(y, log_alphas, axis=0)
+        ddx, ddy = np.gradient(dx, log_alphas, axis=0), np.gradient(dy, log_alphas, axis=0)
+        return (dx * ddy - ddx * dy) / (dx ** 2 + dy ** 2) ** 1.5
+
+    def select(self, alphas, criterion="gcv", noise_level=None, tau=1.0):
+        """
+        Picks alpha from alphas
+        :param alphas: candidate values of the regularization parameter
+        :param criterion: "gcv", "lcurve" or "discrepancy"
+        :param noise_level: standard deviation of the noise on each measurement, needed for "discrepancy"
+        :param tau: safety factor of the discrepancy principle
+        :return: selected alpha, an array of one alpha per frame for a matrix of data
+        """
+        alphas = np.sort(np.asarray(alphas, dtype=float))
+        if criterion == "gcv":
+            return alphas[np.argmin(self.gcv(alphas), axis=0)]
+        elif criterion == "lcurve":
+            if len(alphas) < 3:
+                raise ValueError("L-curve criterion needs at least three values of alpha")
+            # One sided differences at the ends of the grid are unreliable, the corner is searched among interior points
+            return alphas[1 + np.argmax(np.abs(self.lcurve_curvature(alphas))[1:-1], axis=0)]
+        elif criterion == "discrepancy":
+            if noise_level is None:
+                raise ValueError("Discrepancy principle needs the noise level of the measurements")
+            # Largest alpha whose residual does not exceed the expected norm of the noise
+            feasible = self.residual_norms(alphas) <= tau * noise_level * np.sqrt(len(self.data))
+            largest = len(alphas) - 1 - np.argmax(feasible[::-1], axis=0)
+            return np.where(np.any(feasible, axis=0), alphas[largest], alphas[0])[()]
+        else:
+            raise ValueError("Invalid criterion, input should be 'gcv', 'lcurve' or 'discrepancy'")
+
+
+class SparsePath:
+    """
+    Lasso (l1_ratio = 1) and elastic net solutions along a descending sequence of alpha
+    The Gram matrix and A.T @ data are computed once, every alpha is warm started from the previous solution
+    and coordinate descent only runs over the features kept by the sequential strong rule, followed by a KKT check
+    A and data are centered, which matches the intercept fitted by Regularizer.lasso and Regularizer.elasticnet
+    data may be a vector or a links x frames matrix, every frame is centered and walked along the path separately
+    """
+
+    def __init__(self, A, data, l1_ratio=1.0, positive=False, mask=None):
+        self.A = A
+        self.mask = mask    # Support mask of the columns of A, see Regularizer._return_chi
+        self.l1_ratio = l1_ratio
+        self.positive = positive
+
+        self.stacked = np.ndim(data) == 2
+        self.A_centered = A - A.mean(axis=0)
+        self.data_centered = data - data.mean(axis=0)
+        self.gram = self.A_centered.T @ self.A_centered
+        self.Xy = self.A_centered.T @ self.data_centered
+
+        self.coefs = None
+        self.statistics = None
+
+    def get_alphas(self, num=100, eps=1e-3):
+        """
+        Log spaced descending alphas from the smallest alpha with an all-zero solution down to eps times it
+        A matrix of data shares one sequence, starting from the frame that needs the largest alpha
+        """
+        correlation = self.Xy if self.positive else np.abs(self.Xy)
+        alpha_max = np.max(correlation) / (len(self.data_centered) * self.l1_ratio)
+        return np.logspace(np.log10(alpha_max), np.log10(alpha_max * eps), num)
+
+    def screening_scores(self, coef, Xy):
+        """ Correlation of every feature with the residual, from the Gram matrix """
+        gradient = Xy - self.gram @ coef
+        return gradient if self.positive else np.abs(gradient)
+
+    def solutions(self, alphas=None, tol=1e-4, max_iter=1000):
+        """
+        Walks alphas from largest to smallest, storing solutions and per-alpha convergence statistics
+        Output dimension - A.shape[1] x len(alphas), columns ordered like the descending alphas,
+                           with a last axis of frames for a matrix of data
+        For a matrix of data statistics holds one list per frame
+        """
+        alphas = self.get_alphas() if alphas is None else np.sort(np.asarray(alphas, dtype=float))[::-1]
+        if not self.stacked:
+            self.coefs, self.statistics = self.frame_path(self.data_centered, self.Xy, alphas, tol, max_iter)
+            return self.coefs
+
+        paths = [self.frame_path(np.ascontiguousarray(self.data_centered[:, frame]), self.Xy[:, frame], alphas, tol,
+                                 max_iter)
+                 for frame in range(self.data_centered.shape[1])]
+        self.coefs = np.stack([coefs for coefs, _ in paths], axis=2)
+        self.statistics = [statistics for _, statistics in paths]
+        return self.coefs
+
+    def frame_path(self, data_centered, Xy, alphas, tol, max_iter):
+        """ Solutions and statistics along the descending alphas for the centered data of a single frame """
+        from sklearn.linear_model import enet_path
+
+        n, dim = self.A.shape
+        coef = np.zeros(dim)
+        previous_alpha = self.get_alphas(num=1)[0]
+
+        coefs = np.zeros((dim, len(alphas)))
+        statistics = []
+        for index, alpha in enumerate(alphas):
+            start = time.perf_counter()
+            scores = self.screening_scores(coef, Xy)
+            active = (scores >= self.l1_ratio * (2 * alpha - previous_alpha) * n) | (coef != 0)
+
+            passes, n_iter, dual_gap = 0, 0, 0.0
+            while True:
+                passes += 1
+                features = np.nonzero(active)[0]
+                coef = np.zeros(dim)
+                if len(features):
+                    _, path_coefs, dual_gaps, n_iters = enet_path(
+                        self.A_centered[:, features], data_centered, l1_ratio=self.l1_ratio, alphas=[alpha],
+                        precompute=self.gram[np.ix_(features, features)], Xy=Xy[features],
+                        coef_init=coefs[features, index - 1] if index else None,
+                        positive=self.positive, return_n_iter=True, tol=tol, max_iter=max_iter, check_input=False)
+                    coef[features] = path_coefs[:, 0]
+                    n_iter += n_iters[0]
+                    dual_gap = dual_gaps[0]
+
+                # Features discarded by the strong rule that violate the KKT conditions are added back
+                violations = ~active & (self.screening_scores(coef, Xy) > self.l1_ratio * alpha * n * (1 + 1e-9))
+                if not np.any(violations):
+                    break
+                active |= violations
+
+            coefs[:, index] = coef
+            statistics.append({
+                "alpha": float(alpha),
+                "n_iter": int(n_iter),
+                "dual_gap": float(dual_gap),
+                "active_features": int(np.count_nonzero(active)),
+                "nonzero_coefficients": int(np.count_nonzero(coef)),
+                "kkt_passes": passes,
+                "seconds": time.perf_counter() - start
+            })
+            previous_alpha = alpha
+
+        return coefs, statistics
+
+    def reconstruction(self, index):
+        """ Solution number index of the last computed path, reshaped like the output of the Regularizer priors """
+        return Regularizer._return_chi(self.coefs[:, index], self.A, self.mask)
+
+
+if __name__ == '__main__':
+    # A stack of frames gives the same paths and selected alphas as solving every frame on its own
+    rng = np.random.default_rng(0)
+    A = rng.standard_normal((120, 100))
+    data = A @ rng.standard_normal((100, 3)) * [1, 0.1, 10] + 0.5 * rng.standard_normal((120, 3))
+    alphas = np.logspace(-3, 3, 25)
+
+    stacked = RegularizationPath(A, data)
+    frames = [RegularizationPath(A, data[:, frame]) for frame in range(data.shape[1])]
+    for criterion in ("gcv", "lcurve", "discrepancy"):
+        selected = stacked.select(alphas, criterion, noise_level=0.5)
+        print(f"ridge {criterion:12s} alphas {selected} match",
+              np.allclose(selected, [path.select(alphas, criterion, noise_level=0.5) for path in frames]))
+    print("ridge reconstruction", stacked.reconstruction(selected).shape, "max difference",
+          max(np.abs(stacked.reconstruction(selected)[:, :, frame] - path.reconstruction(selected[frame])).max()
+              for frame, path in enumerate(frames)))
+
+    stacked = SparsePath(A, data)
+    alphas = stacked.get_alphas(num=20)
+    coefs = stacked.solutions(alphas)
+    print("lasso path", coefs.shape, "max difference", max(
+        np.abs(coefs[:, :, frame] - SparsePath(A, data[:, frame]).solutions(alphas)).max()
+        for frame in range(data.shape[1])))
@@ -1,30 +1,178 @@
 import numpy as np
-from sklearn.linear_model import Lasso
-from sklearn.linear_model import ElasticNet
-
-from config import Config
+import scipy.sparse as sp
+from scipy.linalg import cho_factor, cho_solve
+from scipy.sparse.linalg import splu, lsqr, LinearOperator
 
 
 class Regularizer:
 
     @staticmethod
-    def _return_chi(chi, A):
-        m = Config.doi["inverse_grids"]
-        if A.shape[1] == m ** 2:
-            chi = np.reshape(chi, (m, m), order='F')
+    def get_image_size(num_grids):
+        """ Side m of the image for m**2 (real) or 2 * m**2 (real and imaginary images) unknowns """
+        for parts in (1, 2):
+            m = int(round(np.sqrt(num_grids / parts)))
+            if parts * m ** 2 == num_grids:
+                return m, parts
+        raise ValueError("Dimensions of model matrix incorrect.")
+
+    @staticmethod
+    def get_mask_columns(mask, parts):
+        """ Unknowns kept by an m x m boolean support mask, in each of the parts (real, imaginary) images """
+        grid_indices = np.flatnonzero(np.ravel(mask, order='F'))
+        return np.concatenate([grid_indices + part * mask.size for part in range(parts)])
+
+    @staticmethod
+    def get_mask_parts(mask, num_grids):
+        """ Number of images (1 real, 2 real and imaginary) for num_grids unknowns restricted to mask """
+        parts = num_grids // max(np.count_nonzero(mask), 1)
+        if parts not in (1, 2) or parts * np.count_nonzero(mask) != num_grids:
+            raise ValueError("Dimensions of model matrix do not match the support mask.")
+        return parts
+
+    @staticmethod
+    def _return_chi(chi, A, mask=None):
+        """
+        Reshapes chi, the solution for model matrix A, into images
+        With a support mask A only has the columns of the grids inside it, chi is scattered back and zero outside
+        """
+        if chi.shape[0] != A.shape[1]:
+            raise ValueError("Dimensions of model matrix incorrect.")
+        if mask is not None:
+            parts = Regularizer.get_mask_parts(mask, A.shape[1])
+            full = np.zeros((parts * mask.size,) + chi.shape[1:], dtype=chi.dtype)
+            full[Regularizer.get_mask_columns(mask, parts)] = chi
+            chi = full
+        return Regularizer.to_images(chi)
+
+    @staticmethod
+    def to_images(chi):
+        """ Reshapes chi into m x m images, or m x m x frames stacks when chi has one column per frame """
+        m, parts = Regularizer.get_image_size(chi.shape[0])
+        shape = (m, m) + chi.shape[1:]
+        if parts == 1:
+            chi = np.reshape(chi, shape, order='F')
             # chi = 1 + np.real(chi)
             chi = np.real(chi)
             return chi
-        elif A.shape[1] == 2 * m ** 2:
+        else:
             chi_real = chi[:m ** 2]
-            chi_real = np.reshape(chi_real, (m, m), order='F')
+            chi_real = np.reshape(chi_real, shape, order='F')
             # chi_real = 1 + chi_real
             chi_real = chi_real
             chi_imag = chi[m ** 2:]
-            chi_imag = np.reshape(chi_imag, (m, m), order='F')
+            chi_imag = np.reshape(chi_imag, shape, order='F')
             return chi_real, chi_imag
+
+    @staticmethod
+    def tikhonov(A, data, alpha, Q=None, form="auto"):
+        """
+        Solves min ||data - A chi||^2 + alpha * chi.T @ Q @ chi through a Cholesky factorization
+        Primal form factorizes the dim x dim matrix A.T @ A + alpha * Q,
+        data-space form factorizes the links x links matrix A @ Q^-1 @ A.T + alpha * I
+        :param A: model matrix
+        :param data: form of measurement data used to solve the inverse problem, a vector or a links x frames matrix
+        :param alpha: regularization parameter
+        :param Q: sparse Tikhonov matrix, identity if None
+        :param form: "primal", "dual" or "auto" to pick the form with the smaller system
+        :return: chi as a vector of length A.shape[1], or A.shape[1] x frames for a matrix of data
+        """
+        links, dim = A.shape
+        if form == "auto":
+            form = "dual" if links < dim else "primal"
+
+        if form == "primal":
+            normal_matrix = A.T @ A
+            if Q is None:
+                normal_matrix[np.diag_indices(dim)] += alpha
+            else:
+                Q = Q.tocoo()
+                normal_matrix[Q.row, Q.col] += alpha * Q.data
+            chi = cho_solve(cho_factor(normal_matrix, overwrite_a=True), A.T @ data)
+        elif form == "dual":
+            Q_inv_At = A.T if Q is None else splu(sp.csc_matrix(Q)).solve(np.asfortranarray(A.T))
+            data_matrix = A @ Q_inv_At
+            data_matrix[np.diag_indices(links)] += alpha
+            chi = Q_inv_At @ cho_solve(cho_factor(data_matrix, overwrite_a=True), data)
         else:
-            raise ValueError("Dimensions of model matrix incorrect.")
+            raise ValueError("Invalid form value, input should be 'primal', 'dual' or 'auto'")
+        return chi
+
+    @staticmethod
+    def iterative_tikhonov(A, data, alpha, L=None, solver="lsqr", tol=1e-6, max_iter=None, noise_level=None):
+        """
+        Solves min ||data - A chi||^2 + alpha * ||L chi||^2 with products by A and A.T only, so A may be a
+        matrix-free LinearOperator; the early stopped iterations themselves act as a regularizer
+        :param A: model matrix or LinearOperator
+        :param data: form of measurement data used to solve the inverse problem, a vector or a links x frames matrix
+        :param alpha: regularization parameter
+        :param L: sparse regularization operator with Q = L.T @ L, identity if None
+        :param solver: "lsqr" (scipy LSQR) or "cgls" (conjugate gradients on the normal equations)
+        :param tol: relative tolerance at which the iterations stop
+        :param max_iter: maximum number of iterations, 2 * A.shape[1] if None
+        :param noise_level: for "cgls", stop as soon as the data residual falls below noise_level * sqrt(links)
+        :return: chi as a vector of length A.shape[1], or A.shape[1] x frames for a matrix of data
+        """
+        if solver not in ("lsqr", "cgls"):
+            raise ValueError("Invalid solver value, input should be 'direct', 'lsqr' or 'cgls'")
+        if data.ndim == 2:
+            return np.column_stack([Regularizer.iterative_tikhonov(A, data[:, frame], alpha, L, solver, tol, max_iter,
+                                                                   noise_level) for frame in range(data.shape[1])])
+        if solver == "cgls":
+            return Regularizer.cgls(A, data, alpha, L, tol, max_iter, noise_level)
+
+        if L is None:
+            return lsqr(A, data, damp=np.sqrt(alpha), atol=tol, btol=tol, iter_lim=max_iter)[0]
+        # Stacked least squares problem [A; sqrt(alpha) L] chi = [data; 0]
+        links = A.shape[0]
+        scale = np.sqrt(alpha)
+        stacked = LinearOperator((links + L.shape[0], A.shape[1]), dtype=float,
+                                 matvec=lambda x: np.concatenate((A @ np.ravel(x), scale * (L @ np.ravel(x)))),
+                                 rmatvec=lambda y: A.T @ np.ravel(y)[:links] + scale * (L.T @ np.ravel(y)[links:]))
+        rhs = np.concatenate((data, np.zeros(L.shape[0])))
+        return lsqr(stacked, rhs, atol=tol, btol=tol, iter_lim=max_iter)[0]
+
+    @staticmethod
+    def cgls(A, data, alpha, L=None, tol=1e-6, max_iter=None, noise_level=None):
+        """
+        CGLS for min ||data - A chi||^2 + alpha * ||L chi||^2, stops when the residual of the normal equations drops
+        below tol times its initial value or, with noise_level, by the discrepancy principle
+        """
+        dim = A.shape[1]
+        max_iter = 2 * dim if max_iter is None else max_iter
+        scale = np.sqrt(alpha)
+        L_apply = (lambda x: x) if L is None else (lambda x: L @ x)
+        L_transpose = (lambda y: y) if L is None else (lambda y: L.T @ y)
+        discrepancy = None if noise_level is None else noise_level * np.sqrt(A.shape[0])
+
+        chi = np.zeros(dim)
+        residual_data = np.array(data, dtype=float)
+        residual_prior = np.zeros(dim if L is None else L.shape[0])
+        s = A.T @ residual_data
+        p = s.copy()
+        gamma = initial_gamma = s @ s
+        for _ in range(max_iter):
+            if gamma <= tol ** 2 * initial_gamma or \
+                    (discrepancy is not None and np.linalg.norm(residual_data) <= discrepancy):
+                break
+            q_data = A @ p
+            q_prior = scale * L_apply(p)
+            step = gamma / (q_data @ q_data + q_prior @ q_prior)
+            chi += step * p
+            residual_data -= step * q_data
+            residual_prior -= step * q_prior
+            s = A.T @ residual_data + scale * L_transpose(residual_prior)
+            gamma, previous_gamma = s @ s, gamma
+            p = s + (gamma / previous_gamma) * p
+        return chi
+
+    @staticmethod
+    def solve_tikhonov(A, data, alpha, Q, L, params):
+        """ Dispatches to the direct or iterative Tikhonov solver chosen by params["solver"], default "direct" """
+        solver = params.get("solver", "direct")
+        if solver == "direct":
+            return Regularizer.tikhonov(A, data, alpha, Q, form=params.get("form", "auto"))
+        return Regularizer.iterative_tikhonov(A, data, alpha, L, solver, params.get("tol", 1e-6),
+                                              params.get("max_iter"), params.get("noise_level"))
 
     @staticmethod
     def ridge(A, data, params: dict):
@@ -33,45 +181,74 @@ class Regularizer:
         Special form of Tikhonov regularization where Tikhonov matrix Q = Identity matrix
         :param A: model matrix
         :param data: form of measurement data used to solve the inverse problem
-        :param params: contains "alpha" representing the regularization parameter
+        :param params: contains "alpha" representing the regularization parameter,
+                                optional "form" ("primal", "dual" or "auto") choosing the system that is factorized,
+                                optional "solver" ("direct", "lsqr" or "cgls") with "tol", "max_iter" and
+                                "noise_level" for the iterative solvers, which also accept a LinearOperator model,
+                                optional "mask", m x m boolean support of the columns of A
         :return: chi if model matrix has m**2 columns,
         chi_real. chi_imag if model matrix has 2 * m**2 columns
         """
-        dim = A.shape[1]
-        chi = np.linalg.inv((A.T @ A) + params["alpha"] * np.eye(dim)) @ A.T @ data
-        return Regularizer._return_chi(chi, A)
+        chi = Regularizer.solve_tikhonov(A, data, params["alpha"], None, None, params)
+        return Regularizer._return_chi(chi, A, params.get("mask"))
 
     @staticmethod
     def difference_operator(m, num_grids, direction, sparse):
-
-        d_row = np.zeros((1, num_grids))
-        d_row[0, 0] = 1
+        """
+        Finite difference operator on the unrolled (order='F') m x m image, as a scipy.sparse matrix
+        Differences are taken along every image line separately, grids beyond the image border are treated as zero
+        :param m: number of grids along one side of the image
+        :param num_grids: number of unknowns, m**2 or 2 * m**2 (real and imaginary images, differenced separately)
+        :param direction: "horizontal" for neighbours one index apart, "vertical" for neighbours m indices apart
+        :param sparse: True for the second order difference (1, -2, 1), False for the first order difference (1, -1)
+        """
+        if sparse:
+            d = sp.diags([1, -2, 1], [0, 1, 2], shape=(m, m), dtype=float)
+        else:
+            d = sp.diags([1, -1], [0, 1], shape=(m, m), dtype=float)
 
         if direction == "horizontal":
-            if sparse:
-                d_row[0, 1] = -2
-                d_row[0, 2] = 1
-            else:
-                d_row[0, 1] = -1
+            d = sp.kron(sp.identity(m), d)
         elif direction == "vertical":
-            if sparse:
-                d_row[0, m] = -2
-                d_row[0, 2*m] = 1
-            else:
-                d_row[0, m] = -1
+            d = sp.kron(d, sp.identity(m))
         else:
             raise ValueError("Invalid direction value for difference operator")
 
-        rows = list()
-        rows.append(d_row)
-        for i in range(0, num_grids - 1):
-            shifted_row = np.roll(d_row, 1)
-            shifted_row[0, 0] = 0
-            rows.append(shifted_row)
-            d_row = shifted_row
+        d = sp.block_diag([d] * (num_grids // m ** 2))
+        return d.tocsr()
+
+    @staticmethod
+    def smoothing_operator(m, num_grids, sparse):
+        """
+        Stacked difference operator L = [Dx; Dy] of the quadratic smoothing prior, as a scipy.sparse matrix
+        """
+        Dx = Regularizer.difference_operator(m, num_grids, "horizontal", sparse=sparse)
+        Dy = Regularizer.difference_operator(m, num_grids, "vertical", sparse=sparse)
+        return sp.vstack((Dx, Dy)).tocsr()
+
+    @staticmethod
+    def smoothing_matrix(m, num_grids, sparse):
+        """
+        Tikhonov matrix Q = Dx.T @ Dx + Dy.T @ Dy of the quadratic smoothing prior, as a scipy.sparse matrix
+        """
+        L = Regularizer.smoothing_operator(m, num_grids, sparse)
+        return (L.T @ L).tocsr()
 
-        d = np.vstack([row for row in rows])
-        return d
+    @staticmethod
+    def get_smoothing(A, params: dict):
+        """
+        Tikhonov matrix Q and stacked difference operator L of the quadratic smoothing prior for the columns of A
+        With params["mask"] the differences are restricted to the grids inside the mask, grids outside are zero
+        """
+        mask = params.get("mask")
+        if mask is None:
+            m, _ = Regularizer.get_image_size(A.shape[1])
+            L = Regularizer.smoothing_operator(m, A.shape[1], sparse=params["sparse"])
+        else:
+            parts = Regularizer.get_mask_parts(mask, A.shape[1])
+            L = Regularizer.smoothing_operator(mask.shape[0], parts * mask.size, sparse=params["sparse"])
+            L = L[:, Regularizer.get_mask_columns(mask, parts)]
+        return (L.T @ L).tocsr(), L
 
     @staticmethod
     def quadratic_smoothing(A, data, params: dict):
@@ -80,18 +257,18 @@ class Regularizer:
         Special form of Tikhonov regularization where Tikhonov matrix Q = Dx.T @ Dx + Dy.T @ Dy
         :param A: model matrix
         :param data: form of measurement data used to solve the inverse problem
-        :param params: contains "alpha" representing the regularization parameter
+        :param params: contains "alpha" representing the regularization parameter,
+                                "sparse" choosing second (True) or first (False) order differences,
+                                optional "form" ("primal", "dual" or "auto") choosing the system that is factorized,
+                                optional "solver" ("direct", "lsqr" or "cgls") with "tol", "max_iter" and
+                                "noise_level" for the iterative solvers, which also accept a LinearOperator model,
+                                optional "mask", m x m boolean support of the columns of A
         :return: chi if model matrix has m**2 columns,
         chi_real. chi_imag if model matrix has 2 * m**2 columns
         """
-        m = Config.doi["inverse_grids"]
-        dim = A.shape[1]
-
-        Dx = Regularizer.difference_operator(m, dim, "horizontal", sparse=params["sparse"])
-        Dy = Regularizer.difference_operator(m, dim, "vertical",  sparse=params["sparse"])
-
-        chi = np.linalg.inv((A.T @ A) + params["alpha"] * (Dx.T @ Dx + Dy.T @ Dy)) @ A.T @ data
-        return Regularizer._return_chi(chi, A)
+        Q, L = Regularizer.get_smoothing(A, params)
+        chi = Regularizer.solve_tikhonov(A, data, params["alpha"], Q, L, params)
+        return Regularizer._return_chi(chi, A, params.get("mask"))
 
     @staticmethod
     def lasso(A, data, params: dict):
@@ -100,14 +277,17 @@ class Regularizer:
         :param A: model matrix
         :param data: measurement data based on the forward model chosen
         :param params: contains "alpha" representing the regularization parameter,
-                                "positive" representing constraint on obtained coefficients
+                                "positive" representing constraint on obtained coefficients,
+                                optional "mask", m x m boolean support of the columns of A
         :return: chi if model matrix has m**2 columns,
         chi_real. chi_imag if model matrix has 2 * m**2 columns
         """
+        from sklearn.linear_model import Lasso
+
         ls = Lasso(params["alpha"], positive=params["positive"])
         ls.fit(A, data)
-        chi = ls.coef_
-        return Regularizer._return_chi(chi, A)
+        chi = ls.coef_.T
+        return Regularizer._return_chi(chi, A, params.get("mask"))
 
     @staticmethod
     def elasticnet(A, data, params: dict):
@@ -117,11 +297,14 @@ class Regularizer:
         :param data: measurement data based on the forward model chosen
         :param params: contains "alpha" representing the regularization parameter of elasticnet,
                                 "l1_ratio" representing the weight of l1 component,
-                                "positive" representing constraint on obtained coefficients
+                                "positive" representing constraint on obtained coefficients,
+                                optional "mask", m x m boolean support of the columns of A
         :return: chi if model matrix has m**2 columns,
         chi_real. chi_imag if model matrix has 2 * m**2 columns
         """
+        from sklearn.linear_model import ElasticNet
+
         ls = ElasticNet(alpha=params["alpha"], l1_ratio=params["l1_ratio"], positive=params["positive"])
         ls.fit(A, data)
-        chi = ls.coef_
-        return Regularizer._return_chi(chi, A)
+        chi = ls.coef_.T
+        return Regularizer._return_chi(chi, A, params.get("mask"))
@@ -1,47 +1,161 @@
 import os
 import sys
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
+from config import Config, Configuration
 from inverse_problem.inverse import LinearInverse
 from inverse_problem.models import PRytov, PRytovComplex, PRytovImag
 from inverse_problem.regularize import Regularizer
+from inverse_problem.path import RegularizationPath, SparsePath
+from utils.doi_utils import DOIUtils
+from utils.profile_utils import Profiler
 
 
 class InverseProblemSolver:
+    """
+    total_power may be a single rx x tx frame or a rx x tx x frames stack measured with the same sensor geometry,
+    a stack is solved with one factorization and returns reconstructions stacked along the last axis
+    Wideband measurements (see ForwardProblemSolver.generate_wideband_data) are given with frequencies, direct_power
+    and total_power then have a last frequency axis; the models of all frequencies are stacked into one joint system
+    for a contrast assumed constant over the band
+    """
 
-    def __init__(self, direct_power, total_power, model_name, prior, params):
+    def __init__(self, direct_power, total_power, model_name, prior, params, profile=None, config=None,
+                 frequencies=None):
         self.direct_power = direct_power
         self.total_power = total_power
+        # Frequency, DOI and sensors, a Configuration or Config if None
+        self.config = config if config is not None else Config
+        # Frequencies of the last axis of direct_power and total_power, None for a single frequency measurement
+        self.frequencies = frequencies
+        if frequencies is not None and direct_power is not None and np.shape(direct_power)[-1] != len(frequencies):
+            raise ValueError("Wideband direct_power should have a last axis of one entry per frequency")
 
         self.model_name = model_name
         self.prior = prior
         self.params = params
+        if params is not None and params.get("mask") is not None:
+            self.params = {**params, "mask": self.get_mask(params["mask"], self.config)}
 
-    def get_model_class(self):
+        # Per-stage timing and memory, enabled by profile=True or the ISP_PROFILE environment variable
+        self.profiler = Profiler(profile)
+
+    def get_model_class(self, config=None):
+        """ Rytov model of config, self.config if None """
+        config = config if config is not None else self.config
         if self.model_name == "prytov":
-            model_class = PRytov()
+            model_class = PRytov(config)
         elif self.model_name == "prytov_complex":
-            model_class = PRytovComplex()
+            model_class = PRytovComplex(config)
         elif self.model_name == "prytov_imag":
-            model_class = PRytovImag()
+            model_class = PRytovImag(config)
         else:
             raise ValueError("Incorrect model name, input should be either 'prytov' or 'prytov_complex'")
         return model_class
 
-    def get_inverse_model(self):
-        inverse_problem = LinearInverse()
-        direct_field = inverse_problem.get_direct_field()
-        incident_field = inverse_problem.get_incident_field()
-        integral_values = inverse_problem.get_greens_integral()
+    @staticmethod
+    def get_mask(mask, config=None):
+        """
+        Support of the unknowns as an m x m boolean array over the inverse grids
+        params["mask"] is either an m x m array over the grids, nonzero entries are kept (e.g. a 0/1 integer mask),
+        or a region of interest polygon, a sequence of at least three (x, y) vertices
+        """
+        mask = np.asarray(mask)
+        m = DOIUtils.get_grid_count("inverse", config=config)
+        if mask.shape == (m, m):
+            mask = mask.astype(bool)
+        elif mask.dtype != bool and mask.ndim == 2 and mask.shape[1] == 2 and len(mask) >= 3:
+            mask = DOIUtils.get_polygon_mask(mask, "inverse", config=config)
+        else:
+            raise ValueError(f"Support mask should be a {m} x {m} array over the inverse grids or an (n, 2) sequence "
+                             f"of at least three polygon vertices, got shape {mask.shape}")
+        if not mask.any():
+            raise ValueError("Support mask does not contain any grid")
+        return mask
 
-        model_class = self.get_model_class()
-        A = model_class.get_model(direct_field, incident_field, integral_values)
+    def is_matrix_free(self):
+        """ Iterative solvers ("solver": "lsqr" or "cgls" in params) work on a LinearOperator instead of the matrix """
+        return self.params is not None and self.params.get("solver", "direct") != "direct"
+
+    def get_configs(self):
+        """ Configuration of every frequency of a wideband measurement, only self.config for a single frequency """
+        if self.frequencies is None:
+            return [self.config]
+        base = Configuration.from_config(self.config)
+        return [base.replace(system={"frequency": frequency}) for frequency in self.frequencies]
+
+    def get_inverse_model(self, grids=None, grid_indices=None):
+        """
+        Model matrix, or LinearOperator for the iterative solvers
+        For a wideband measurement the models of the frequencies are stacked, one block of rows per frequency
+        :param grids: number of inverse grids along one side of the DOI, config.doi["inverse_grids"] if None
+        :param grid_indices: unrolled (order='F') grids kept as unknowns, the grids of params["mask"] if None
+        """
+        if grids is None and grid_indices is None and self.params is not None and self.params.get("mask") is not None:
+            grid_indices = np.flatnonzero(self.params["mask"].ravel(order='F'))
+        if self.frequencies is None:
+            A = self.get_frequency_model(self.config, grids, grid_indices)
+        else:
+            models, distances = [], {}
+            for frequency, config in zip(self.frequencies, self.get_configs()):
+                with self.profiler.stage(f"frequency_{frequency:g}"):
+                    models.append(self.get_frequency_model(config, grids, grid_indices, distances))
+            A = InverseProblemSolver.stack_models(models)
+        self.profiler.record_arrays(model=A)
         return A
 
+    def get_frequency_model(self, config, grids=None, grid_indices=None, distances=None):
+        """
+        Model of a single frequency, see get_inverse_model
+        :param distances: distance matrices shared by the models of all frequencies, see LinearInverse.get_distances
+        """
+        inverse_problem = LinearInverse(grids, config)
+        if distances is not None:
+            inverse_problem.distances = distances
+        with self.profiler.stage("direct_field"):
+            direct_field = inverse_problem.get_direct_field()
+        with self.profiler.stage("incident_field"):
+            incident_field = inverse_problem.get_incident_field()
+        with self.profiler.stage("greens_integral"):
+            integral_values = inverse_problem.get_greens_integral()
+        self.profiler.record_arrays(incident_field=incident_field, greens_integral=integral_values)
+        if grid_indices is not None:
+            incident_field = incident_field[grid_indices]
+            integral_values = integral_values[:, grid_indices]
+
+        model_class = self.get_model_class(config)
+        with self.profiler.stage("model"):
+            if self.is_matrix_free():
+                return model_class.get_operator(direct_field, incident_field, integral_values)
+            return model_class.get_model(direct_field, incident_field, integral_values)
+
+    @staticmethod
+    def stack_models(models):
+        """ Joint system of the models of several frequencies, a LinearOperator if they are LinearOperators """
+        if not isinstance(models[0], LinearOperator):
+            return np.vstack(models)
+        splits = np.cumsum([model.shape[0] for model in models])[:-1]
+
+        def rmatvec(w):
+            return sum(model.rmatvec(part) for model, part in zip(models, np.split(np.ravel(w), splits)))
+
+        shape = (sum(model.shape[0] for model in models), models[0].shape[1])
+        return LinearOperator(shape, matvec=lambda x: np.concatenate([model.matvec(x) for model in models]),
+                              rmatvec=rmatvec, dtype=float)
+
     def get_measurement_data(self):
+        """ Data of the links, for a wideband measurement those of every frequency in the order of the model rows """
         model_class = self.get_model_class()
-        y = model_class.get_data(self.total_power, self.direct_power)
+        with self.profiler.stage("measurement_data"):
+            if self.frequencies is None:
+                y = model_class.get_data(self.total_power, self.direct_power)
+            else:
+                y = np.concatenate([model_class.get_data(self.total_power[..., index], self.direct_power[..., index])
+                                    for index in range(len(self.frequencies))])
+        self.profiler.record_arrays(data=y)
         return y
 
     def get_regularizer(self):
@@ -53,11 +167,117 @@ class InverseProblemSolver:
         }
         if self.prior not in mapping.keys():
             raise ValueError("Invalid prior value")
+        if self.is_matrix_free() and self.prior not in ("ridge", "qs2D"):
+            raise ValueError("Iterative solvers are only available for 'ridge' and 'qs2D' priors")
         return mapping[self.prior]
 
     def solve(self):
+        self.profiler.reset()
         model = self.get_inverse_model()
         data = self.get_measurement_data()
         regularizer = self.get_regularizer()
-        chi = regularizer(model, data, self.params)
+        with self.profiler.stage("regularizer"):
+            chi = regularizer(model, data, self.params)
+        self.profiler.record_arrays(chi=chi)
+        self.profiler.emit(f"inverse_{self.model_name}_{self.prior}")
         return chi
+
+    def get_regularization_path(self):
+        """
+        "ridge", "qs2D": RegularizationPath, the model is factorized once and solutions for any alpha come from it
+        "lasso", "elasticnet": SparsePath, warm started coordinate descent over a descending alpha sequence,
+                               using "positive" and, for elasticnet, "l1_ratio" from params
+        A stack of frames gives one path per frame, see RegularizationPath and SparsePath
+        """
+        if self.is_matrix_free():
+            raise ValueError("Regularization paths need the model matrix, use the 'direct' solver")
+        model = self.get_inverse_model()
+        data = self.get_measurement_data()
+        mask = self.params.get("mask")
+        if self.prior == "ridge":
+            return RegularizationPath(model, data, mask=mask)
+        elif self.prior == "qs2D":
+            Q, _ = Regularizer.get_smoothing(model, self.params)
+            return RegularizationPath(model, data, Q, mask)
+        elif self.prior == "lasso":
+            return SparsePath(model, data, 1.0, self.params.get("positive", False), mask)
+        elif self.prior == "elasticnet":
+            return SparsePath(model, data, self.params["l1_ratio"], self.params.get("positive", False), mask)
+        else:
+            raise ValueError("Invalid prior value")
+
+    def solve_path(self, alphas, criterion="gcv"):
+        """
+        Selects alpha from alphas with criterion ("gcv", "lcurve" or "discrepancy") and returns it with its reconstruction
+        For "discrepancy" params must contain "noise_level", the noise standard deviation of each measurement
+        For a stack of frames alpha is selected per frame, the array of alphas is returned with the stacked reconstructions
+        """
+        if self.prior not in ("ridge", "qs2D"):
+            raise ValueError("Alpha selection is only available for 'ridge' and 'qs2D' priors")
+        path = self.get_regularization_path()
+        alpha = path.select(alphas, criterion, noise_level=self.params.get("noise_level"))
+        return alpha, path.reconstruction(alpha)
+
+    def solve_multiresolution(self, coarse_grids, fine_grids, threshold=0.5, dilation=1, fine_alpha=None):
+        """
+        Reconstructs on a coarse grid, then re-solves on the fine grid only over the detected region of support
+        The fine solve looks for a correction to the coarse reconstruction interpolated onto the fine grid,
+        grids outside the support are set to zero; only available for the "ridge" and "qs2D" priors
+        :param coarse_grids: number of grids along one side of the DOI for the first reconstruction
+        :param fine_grids: number of grids along one side of the DOI for the final reconstruction
+        :param threshold: coarse grids whose magnitude exceeds threshold times the largest one form the support
+        :param dilation: number of coarse grids by which the support is grown on every side
+        :param fine_alpha: regularization parameter of the fine solve, params["alpha"] if None
+        :return: fine reconstruction shaped like the output of solve()
+        """
+        if self.prior not in ("ridge", "qs2D"):
+            raise ValueError("Multi-resolution reconstruction is only available for 'ridge' and 'qs2D' priors")
+        if self.params.get("mask") is not None:
+            raise ValueError("Multi-resolution reconstruction finds its own support, remove 'mask' from params")
+        if fine_alpha is None:
+            fine_alpha = self.params["alpha"]
+        from scipy.ndimage import binary_dilation, map_coordinates
+
+        self.profiler.reset()
+        data = self.get_measurement_data()
+        with self.profiler.stage("coarse"):
+            coarse_model = self.get_inverse_model(coarse_grids)
+            coarse_chi = self.get_regularizer()(coarse_model, data, self.params)
+        images = coarse_chi if isinstance(coarse_chi, tuple) else (coarse_chi,)
+
+        with self.profiler.stage("support"):
+            # Support of all frames together, grown by dilation and mapped to the fine grids it covers
+            magnitude = np.sqrt(sum(np.abs(image) ** 2 for image in images))
+            if magnitude.ndim == 3:
+                magnitude = magnitude.max(axis=2)
+            coarse_support = magnitude > threshold * magnitude.max()
+            if dilation:
+                coarse_support = binary_dilation(coarse_support, iterations=dilation)
+            nearest = np.arange(fine_grids) * coarse_grids // fine_grids
+            self.support = coarse_support[np.ix_(nearest, nearest)]
+            grid_indices = np.flatnonzero(self.support.ravel(order='F'))
+
+            # Coarse reconstruction interpolated at the fine grid centroids as the starting point
+            coordinates = (np.arange(fine_grids) + 0.5) * coarse_grids / fine_grids - 0.5
+            rows, cols = np.meshgrid(coordinates, coordinates, indexing='ij')
+            warm_start = []
+            for image in images:
+                frames = image.reshape(coarse_grids, coarse_grids, -1)
+                fine = np.stack([map_coordinates(frames[:, :, frame], [rows, cols], order=1, mode='nearest')
+                                 for frame in range(frames.shape[2])], axis=2)
+                warm_start.append(fine.reshape(fine_grids ** 2, -1, order='F')[grid_indices])
+            warm_start = np.concatenate(warm_start)
+            if data.ndim == 1:
+                warm_start = warm_start[:, 0]
+
+        with self.profiler.stage("fine"):
+            fine_model = self.get_inverse_model(fine_grids, grid_indices)
+            Q = L = None
+            if self.prior == "qs2D":
+                # Smoothing over the fine grids of the support only
+                Q, L = Regularizer.get_smoothing(fine_model, {**self.params, "mask": self.support})
+            correction = Regularizer.solve_tikhonov(fine_model, data - fine_model @ warm_start, fine_alpha, Q, L,
+                                                    self.params)
+
+        self.profiler.emit(f"inverse_multiresolution_{self.model_name}_{self.prior}")
+        return Regularizer._return_chi(warm_start + correction, fine_model, self.support)
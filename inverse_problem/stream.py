@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from inverse_problem.solve import InverseProblemSolver
+from inverse_problem.regularize import Regularizer
+
+
+class StreamingReconstructor:
+    """
+    Reconstructs a continuous stream of RSSI frames for a fixed sensor geometry and direct power
+    The model matrix and, for the "ridge" and "qs2D" priors, the linear reconstruction operator are computed once,
+    so every frame costs one matrix-vector product; "lasso", "elasticnet" and the iterative solvers run their
+    regularizer on every frame
+    """
+
+    def __init__(self, direct_power, model_name, prior, params, smoothing=0.0, background_frames=0, max_backlog=None,
+                 config=None):
+        """
+        :param direct_power: direct power without any scatterer, shared by all frames
+        :param model_name: "prytov", "prytov_complex" or "prytov_imag"
+        :param prior: "ridge", "qs2D", "lasso" or "elasticnet"
+        :param params: parameters of the prior, as for InverseProblemSolver
+        :param smoothing: weight of the previous frame in the exponential moving average of the data, 0 disables it
+        :param background_frames: number of leading frames averaged into a background that is subtracted from later frames
+        :param max_backlog: for asynchronous streams, older frames are dropped when more than this many are waiting
+        :param config: Configuration of the frequency, DOI and sensors, Config if None
+        """
+        self.direct_power = direct_power
+        self.smoothing = smoothing
+        self.background_frames = background_frames
+        self.max_backlog = max_backlog
+
+        self.solver = InverseProblemSolver(direct_power, None, model_name, prior, params, config=config)
+        self.model_class = self.solver.get_model_class()
+        self.model = self.solver.get_inverse_model()
+        self.regularizer = self.solver.get_regularizer()
+        self.operator = self.get_reconstruction_operator()
+
+        self.smoothed_data = None
+        self.background = None
+        self.background_sum = 0
+        self.background_count = 0
+
+        self.latencies = []
+        self.dropped = 0
+        self.start_time = None
+        self.end_time = None
+
+    def get_reconstruction_operator(self):
+        """ Matrix mapping a data vector to chi for the linear priors, None for the sparse priors """
+        prior, params = self.solver.prior, self.solver.params
+        if self.solver.is_matrix_free():
+            return None
+        identity = np.eye(self.model.shape[0])
+        if prior == "ridge":
+            return Regularizer.tikhonov(self.model, identity, params["alpha"], form=params.get("form", "auto"))
+        elif prior == "qs2D":
+            Q, _ = Regularizer.get_smoothing(self.model, params)
+            return Regularizer.tikhonov(self.model, identity, params["alpha"], Q, form=params.get("form", "auto"))
+        return None
+
+    def preprocess(self, total_power):
+        """ Measurement data of one frame after temporal smoothing and background subtraction,
+        None while the background is still being collected """
+        data = self.model_class.get_data(total_power, self.direct_power)
+
+        if self.smoothing and self.smoothed_data is not None:
+            data = self.smoothing * self.smoothed_data + (1 - self.smoothing) * data
+        self.smoothed_data = data
+
+        if self.background_count < self.background_frames:
+            self.background_sum = self.background_sum + data
+            self.background_count += 1
+            self.background = self.background_sum / self.background_count
+            return None
+        if self.background is not None:
+            data = data - self.background
+        return data
+
+    def reconstruct(self, total_power):
+        """ Reconstruction of a single frame, None while the background is still being collected """
+        start = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = start
+
+        data = self.preprocess(total_power)
+        if data is None:
+            return None
+        if self.operator is not None:
+            chi = Regularizer._return_chi(self.operator @ data, self.model, self.solver.params.get("mask"))
+        else:
+            chi = self.regularizer(self.model, data, self.solver.params)
+
+        self.end_time = time.perf_counter()
+        self.latencies.append(self.end_time - start)
+        return chi
+
+    def run(self, frames):
+        """ Yields the reconstruction of every total power frame of an iterator """
+        for total_power in frames:
+            chi = self.reconstruct(total_power)
+            if chi is not None:
+                yield chi
+
+    async def run_async(self, queue):
+        """
+        Yields reconstructions of total power frames taken from an asyncio.Queue until None is received
+        When more than max_backlog frames are waiting, the oldest ones are dropped to bound the latency
+        """
+        while True:
+            total_power = await queue.get()
+            if self.max_backlog is not None:
+                while total_power is not None and queue.qsize() > self.max_backlog:
+                    total_power = queue.get_nowait()
+                    self.dropped += 1
+            if total_power is None:
+                break
+            chi = self.reconstruct(total_power)
+            if chi is not None:
+                yield chi
+
+    def get_statistics(self):
+        """ Per-frame latency in seconds and throughput in frames per second of the frames reconstructed so far """
+        latencies = np.asarray(self.latencies)
+        if not len(latencies):
+            return {"frames": 0, "dropped": self.dropped}
+        elapsed = self.end_time - self.start_time
+        return {
+            "frames": len(latencies),
+            "dropped": self.dropped,
+            "latency_mean": float(np.mean(latencies)),
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p95": float(np.percentile(latencies, 95)),
+            "latency_max": float(np.max(latencies)),
+            "frames_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0
+        }
@@ -9,11 +9,11 @@ from utils.doi_utils import DOIUtils
 
 class Scatterer:
 
-    def __init__(self, problem, inverse_type, scatterer_params: list):
+    def __init__(self, problem, inverse_type, scatterer_params: list, config=None):
         self.problem = problem
         self.inverse_type = inverse_type
         self.scatterer_params = scatterer_params
-        self.grid_positions = DOIUtils.get_grid_centroids(problem)
+        self.grid_positions = DOIUtils.get_grid_centroids(problem, config=config)
         m = len(self.grid_positions[0])
 
         m = len(self.grid_positions[0])
@@ -0,0 +1,139 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+
+from config import Config
+
+
+class OperatorCache:
+    """
+    Cache of scatterer independent operators (direct field, incident field, Green's matrices) in two layers:
+        disk   - .npy files named by a hash of the configuration fields an operator depends on, shared by processes
+        memory - the most recently used operators of the process, shared by its threads
+    Configurations that agree on those fields share operators, e.g. two configurations differing only in the number
+    of inverse grids share the direct field.
+    Operators are returned read-only (memory-mapped from disk or held in memory), copy them before modifying them.
+    """
+
+    memory = OrderedDict()      # Key to operator, least recently used first
+    lock = threading.Lock()     # Guards memory and key_locks
+    key_locks = {}              # Lock and number of threads using it of every key being loaded, see key_lock
+
+    @staticmethod
+    def get_key(name, problem, grids=None, config=None):
+        """
+        Hash of the configuration fields an operator depends on
+        :param name: operator name
+        :param problem: "forward" or "inverse" for operators defined on the DOI grids, None for sensor-only operators
+        :param grids: number of grids along one side of the DOI when it differs from the configured value
+        :param config: Configuration the operator is computed for, Config if None
+        """
+        config = config if config is not None else Config
+        fields = {
+            "name": name,
+            "frequency": config.system["frequency"],
+            "sensor_positions": np.asarray(config.sensors["positions"], dtype=float).tolist()
+        }
+        if problem is not None:
+            fields["doi"] = {key: config.doi[key] for key in ("length", "width", "origin")}
+            fields["grids"] = config.doi[problem + "_grids"] if grids is None else grids
+        fields = json.dumps(fields, sort_keys=True)
+        return f"{name}_{hashlib.sha1(fields.encode()).hexdigest()[:16]}"
+
+    @staticmethod
+    def get_path(key, config=None):
+        config = config if config is not None else Config
+        return os.path.join(config.cache["directory"], key + ".npy")
+
+    @staticmethod
+    def load(name, problem, compute, grids=None, config=None):
+        """
+        Returns the cached operator, calling compute() and storing its output on a cache miss
+        """
+        config = config if config is not None else Config
+        if not config.cache["enabled"]:
+            return compute()
+
+        key = OperatorCache.get_key(name, problem, grids, config)
+        with OperatorCache.key_lock(key):
+            with OperatorCache.lock:
+                if key in OperatorCache.memory:
+                    OperatorCache.memory.move_to_end(key)
+                    return OperatorCache.memory[key]
+
+            path = OperatorCache.get_path(key, config)
+            if os.path.exists(path):
+                os.utime(path)
+                value = np.load(path, mmap_mode='r')
+            else:
+                value = np.asarray(compute())
+                os.makedirs(config.cache["directory"], exist_ok=True)
+                # Write to a temporary file first so concurrent processes never read a partial array
+                temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(temporary_path, "wb") as file:
+                    np.save(file, value)
+                os.replace(temporary_path, path)
+                OperatorCache.evict(config)
+                value = value.view()
+                value.flags.writeable = False
+
+            with OperatorCache.lock:
+                OperatorCache.memory[key] = value
+                OperatorCache.evict_memory(config)
+            return value
+
+    @staticmethod
+    @contextmanager
+    def key_lock(key):
+        """
+        Holds the lock of key, so concurrent threads compute a missing operator only once
+        The lock is dropped once no thread uses it, key_locks only holds the keys being loaded
+        """
+        with OperatorCache.lock:
+            entry = OperatorCache.key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with OperatorCache.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del OperatorCache.key_locks[key]
+
+    @staticmethod
+    def evict_memory(config=None):
+        """ Drops least recently used operators from memory until they fit in config.cache["memory_size"] bytes """
+        config = config if config is not None else Config
+        total_size = sum(value.nbytes for value in OperatorCache.memory.values())
+        while len(OperatorCache.memory) > 1 and total_size > config.cache.get("memory_size", 0):
+            _, value = OperatorCache.memory.popitem(last=False)
+            total_size -= value.nbytes
+
+    @staticmethod
+    def evict(config=None):
+        """ Removes least recently used operators until the cache fits in config.cache["max_size"] bytes """
+        config = config if config is not None else Config
+        directory = config.cache["directory"]
+        paths = [os.path.join(directory, file) for file in os.listdir(directory) if file.endswith(".npy")]
+        paths.sort(key=os.path.getmtime)
+        total_size = sum(os.path.getsize(path) for path in paths)
+        while paths and total_size > config.cache["max_size"]:
+            path = paths.pop(0)
+            total_size -= os.path.getsize(path)
+            os.remove(path)
+
+    @staticmethod
+    def clear(config=None):
+        config = config if config is not None else Config
+        with OperatorCache.lock:
+            OperatorCache.memory.clear()
+        directory = config.cache["directory"]
+        if os.path.isdir(directory):
+            for file in os.listdir(directory):
+                if file.endswith(".npy"):
+                    os.remove(os.path.join(directory, file))
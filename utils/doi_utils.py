@@ -6,39 +6,108 @@ from config import Config
 class DOIUtils:
 
     @staticmethod
-    def get_grid_centroids(problem):
+    def get_grid_count(problem, grids=None, config=None):
+        """
+        Number of grids along one side of the DOI, grids overrides the configured value when given
+        Every method reads the DOI of config, a Configuration or Config when None
+        """
+        if problem not in ("forward", "inverse"):
+            raise ValueError("Incorrect value of problem")
+        config = config if config is not None else Config
+        return config.doi[problem + "_grids"] if grids is None else grids
+
+    @staticmethod
+    def get_grid_length(problem, grids=None, config=None):
+        """ Side length of a single square grid of the DOI """
+        config = config if config is not None else Config
+        return config.doi["length"] / DOIUtils.get_grid_count(problem, grids, config)
+
+    @staticmethod
+    def get_grid_centroids(problem, grids=None, config=None):
         """
         Returns x and y coordinates for centroids of all grids
         Two m x m arrays, one for x coordinates of the grids, one for y coordinates
         """
-        if problem == "forward":
-            grid_length = Config.doi["length"] / Config.doi["forward_grids"]
-        elif problem == "inverse":
-            grid_length = Config.doi["length"] / Config.doi["inverse_grids"]
-        else:
-            raise ValueError("Incorrect value of problem")
+        config = config if config is not None else Config
+        grid_length = DOIUtils.get_grid_length(problem, grids, config)
 
-        if Config.doi["origin"] == "center":
-            centroids_x = np.arange(start=- Config.doi["length"] / 2 + grid_length / 2, stop=Config.doi["length"] / 2,
+        if config.doi["origin"] == "center":
+            centroids_x = np.arange(start=- config.doi["length"] / 2 + grid_length / 2, stop=config.doi["length"] / 2,
                                     step=grid_length)
-            centroids_y = np.arange(start=Config.doi["length"] / 2 - grid_length / 2, stop=-Config.doi["length"] / 2,
+            centroids_y = np.arange(start=config.doi["length"] / 2 - grid_length / 2, stop=-config.doi["length"] / 2,
                                     step=-grid_length)
         else:
-            centroids_x = np.arange(start=grid_length / 2, stop=Config.doi["length"], step=grid_length)
-            centroids_y = np.arange(start=Config.doi["length"] - grid_length / 2, stop=0, step=-grid_length)
+            centroids_x = np.arange(start=grid_length / 2, stop=config.doi["length"], step=grid_length)
+            centroids_y = np.arange(start=config.doi["length"] - grid_length / 2, stop=0, step=-grid_length)
         return np.meshgrid(centroids_x, centroids_y)
 
     @staticmethod
-    def get_grid_radius(problem):
-        if problem == "forward":
-            grid_length = Config.doi["length"] / Config.doi["forward_grids"]
-        elif problem == "inverse":
-            grid_length = Config.doi["length"] / Config.doi["inverse_grids"]
-        else:
-            raise ValueError("Incorrect value of problem")
+    def get_grid_radius(problem, grids=None, config=None):
+        grid_length = DOIUtils.get_grid_length(problem, grids, config)
         grid_radius = np.sqrt(grid_length ** 2 / np.pi)
         return grid_radius
 
+    @staticmethod
+    def get_polygon_mask(polygon, problem, grids=None, config=None):
+        """
+        Grids whose centroid lies inside a polygon, found by ray casting
+        :param polygon: sequence of (x, y) vertices in DOI coordinates
+        Output dimension - m x m boolean array, laid out like the grid centroids
+        """
+        centroids_x, centroids_y = DOIUtils.get_grid_centroids(problem, grids, config)
+        vertices = np.asarray(polygon, dtype=float)
+        inside = np.zeros(centroids_x.shape, dtype=bool)
+        for (x1, y1), (x2, y2) in zip(vertices, np.roll(vertices, -1, axis=0)):
+            crosses = (y1 > centroids_y) != (y2 > centroids_y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                crossing_x = x1 + (centroids_y - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (centroids_x < crossing_x)
+        return inside
+
+    @staticmethod
+    def get_offset_distances(problem, config=None):
+        """
+        Distance between two grid centroids as a function of their integer (row, column) offset
+        Output dimension - m x m, entry [di, dj] is the distance between grids di rows and dj columns apart
+        """
+        grid_length = DOIUtils.get_grid_length(problem, config=config)
+        m = len(DOIUtils.get_grid_centroids(problem, config=config)[0])
+        offsets = np.arange(m)
+        [di, dj] = np.meshgrid(offsets, offsets, indexing='ij')
+        return grid_length * np.sqrt(di ** 2 + dj ** 2)
+
+    @staticmethod
+    def get_sensor_distances(config=None):
+        """
+        Distance between every receiver and every transmitter
+        Output dimension - number of receivers x number of transmitters
+        """
+        config = config if config is not None else Config
+        sensor_x = [pos[0] for pos in config.sensors["positions"]]
+        sensor_y = [pos[1] for pos in config.sensors["positions"]]
+
+        [xt, xr] = np.meshgrid(sensor_x, sensor_x)
+        [yt, yr] = np.meshgrid(sensor_y, sensor_y)
+        return np.sqrt((xt - xr) ** 2 + (yt - yr) ** 2)
+
+    @staticmethod
+    def get_sensor_grid_distances(problem, grids=None, config=None):
+        """
+        Distance between every grid centroid, unrolled with order='F', and every sensor
+        Output dimension - number of grids x number of sensors
+        """
+        config = config if config is not None else Config
+        sensor_x = [pos[0] for pos in config.sensors["positions"]]
+        sensor_y = [pos[1] for pos in config.sensors["positions"]]
+
+        grid_positions = DOIUtils.get_grid_centroids(problem, grids, config)
+        grid_x = grid_positions[0].reshape(grid_positions[0].size, order='F')
+        grid_y = grid_positions[1].reshape(grid_positions[1].size, order='F')
+
+        [xs, xg] = np.meshgrid(sensor_x, grid_x)
+        [ys, yg] = np.meshgrid(sensor_y, grid_y)
+        return np.sqrt((xs - xg) ** 2 + (ys - yg) ** 2)
+
 
 if __name__ == '__main__':
 
@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
 
 from config import Config
 
@@ -7,9 +6,12 @@ from config import Config
 class PlotUtils:
 
     @staticmethod
-    def plot_setup():
-        room_config = Config.room
-        doi_config = Config.doi
+    def plot_setup(config=None):
+        import matplotlib.pyplot as plt
+
+        config = config if config is not None else Config
+        room_config = config.room
+        doi_config = config.doi
         ratio = room_config["length"] / doi_config["length"]
         grids = int(doi_config["forward_grids"] * ratio)
 
@@ -20,24 +22,45 @@ class PlotUtils:
         else:
             diff = int(grids/2)
             image[diff:doi_config["forward_grids"], diff:doi_config["forward_grids"]] = 0
-        plt.imshow(image, cmap=plt.cm.gray, extent=PlotUtils.get_room_extent())
+        plt.imshow(image, cmap=plt.cm.gray, extent=PlotUtils.get_room_extent(config))
         plt.show()
 
     @staticmethod
-    def get_doi_extent():
-        doi_length = Config.doi["length"]
-        doi_width = Config.doi["width"]
-        if Config.doi["origin"] == "center":
+    def save_images(path, images, extent=None):
+        """
+        Saves images side by side with colorbars to path without opening a window
+        :param images: dictionary of title to m x m image
+        :param extent: axes extent of the images, the DOI if None
+        """
+        import matplotlib.pyplot as plt
+
+        extent = PlotUtils.get_doi_extent() if extent is None else extent
+        figure, axes = plt.subplots(ncols=len(images), figsize=(5 * len(images), 4), squeeze=False)
+        for ax, (title, image) in zip(axes[0], images.items()):
+            plot = ax.imshow(image, cmap=plt.cm.jet, extent=extent)
+            figure.colorbar(plot, ax=ax, fraction=0.046, pad=0.04)
+            ax.title.set_text(title)
+        figure.tight_layout()
+        figure.savefig(path)
+        plt.close(figure)
+
+    @staticmethod
+    def get_doi_extent(config=None):
+        config = config if config is not None else Config
+        doi_length = config.doi["length"]
+        doi_width = config.doi["width"]
+        if config.doi["origin"] == "center":
             extent = [-doi_length/2, doi_length/2, -doi_width/2, doi_width/2]
         else:
             extent = [0, doi_length, 0, doi_width]
         return extent
 
     @staticmethod
-    def get_room_extent():
-        room_length = Config.room["length"]
-        room_width = Config.room["width"]
-        if Config.room["origin"] == "center":
+    def get_room_extent(config=None):
+        config = config if config is not None else Config
+        room_length = config.room["length"]
+        room_width = config.room["width"]
+        if config.room["origin"] == "center":
             extent = [-room_length / 2, room_length / 2, -room_width / 2, room_width / 2]
         else:
             extent = [0, room_length, 0, room_width]
@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Profiler:
+    """
+    Records wall time, peak allocation and array sizes of named solver stages
+    Disabled by default, enabled by passing enabled=True or setting the environment variable ISP_PROFILE
+    (ISP_PROFILE=1 records time and memory, ISP_PROFILE=time records time only, since memory tracing slows allocations)
+    Reports are written as JSON to ISP_PROFILE_DIR (default data/profiles) and printed as a table
+    """
+
+    def __init__(self, enabled=None, memory=None):
+        setting = os.environ.get("ISP_PROFILE", "")
+        self.enabled = bool(setting) and setting != "0" if enabled is None else enabled
+        self.memory = setting != "time" if memory is None else memory
+        self.records = []
+        self.stack = []
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        record = {"stage": "/".join([parent["stage"] for parent in self.stack] + [name]), "seconds": None,
+                  "peak_bytes": None, "arrays": {}}
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1]["running_peak"] = max(self.stack[-1]["running_peak"], peak)
+            tracemalloc.reset_peak()
+            record["start_memory"] = current
+            record["running_peak"] = current
+
+        self.stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            self.stack.pop()
+            if self.memory:
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, record.pop("running_peak"))
+                record["peak_bytes"] = peak - record.pop("start_memory")
+                if self.stack:
+                    self.stack[-1]["running_peak"] = max(self.stack[-1]["running_peak"], peak)
+                else:
+                    tracemalloc.stop()
+            self.records.append(record)
+
+    def record_arrays(self, **arrays):
+        """ Attaches shape, dtype and size of arrays to the most recently finished stage """
+        if not self.enabled or not self.records:
+            return
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            self.records[-1]["arrays"][name] = {"shape": list(array.shape), "dtype": str(array.dtype),
+                                                "nbytes": int(array.nbytes)}
+
+    def report(self):
+        return {"total_seconds": sum(record["seconds"] for record in self.records if "/" not in record["stage"]),
+                "stages": self.records}
+
+    def table(self):
+        lines = [f"{'stage':40s} {'seconds':>10s} {'peak MiB':>10s}  arrays"]
+        for record in self.records:
+            peak = "" if record["peak_bytes"] is None else f"{record['peak_bytes'] / 2 ** 20:10.2f}"
+            arrays = ", ".join(f"{name} {tuple(info['shape'])} {info['nbytes'] / 2 ** 20:.2f} MiB"
+                               for name, info in record["arrays"].items())
+            lines.append(f"{record['stage']:40s} {record['seconds']:10.4f} {peak:>10s}  {arrays}")
+        lines.append(f"{'total':40s} {self.report()['total_seconds']:10.4f}")
+        return "\n".join(lines)
+
+    def emit(self, run_name):
+        """ Writes the JSON report of this run and prints the table, does nothing when disabled """
+        if not self.enabled:
+            return None
+        directory = os.environ.get("ISP_PROFILE_DIR", "data/profiles")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{run_name}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.json")
+        with open(path, "w") as file:
+            json.dump({"run": run_name, **self.report()}, file, indent=2)
+        print(f"Profile of {run_name}, written to {path}")
+        print(self.table())
+        return path
+
+    def reset(self):
+        self.records = []
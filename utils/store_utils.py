@@ -0,0 +1,227 @@
+import os
+import json
+import shutil
+import numpy as np
+
+from config import Config
+
+
+class ChunkedArray:
+    """
+    Read-only view of a dataset of a DatasetStore, chunks are only loaded when indexed
+    Indexing follows numpy along the first (sample) axis: integers, slices, integer arrays and boolean masks,
+    optionally followed by indices into every sample
+    """
+
+    def __init__(self, path, info, chunk_size):
+        self.path = path
+        self.shape = tuple(info["shape"])
+        self.dtype = np.dtype(info["dtype"])
+        self.compress = info["compress"]
+        self.chunk_size = chunk_size
+        self.last_chunk = (None, None)   # Most recently read chunk, sequential reads decompress it only once
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_chunk_path(self, chunk):
+        return os.path.join(self.path, f"chunk_{chunk:05d}" + (".npz" if self.compress else ".npy"))
+
+    def read_chunk(self, chunk):
+        if self.last_chunk[0] == chunk:
+            return self.last_chunk[1]
+        rows = min(self.chunk_size, len(self) - chunk * self.chunk_size)
+        if self.compress:
+            with np.load(self.get_chunk_path(chunk)) as file:
+                data = file["data"][:rows]
+        else:
+            data = np.load(self.get_chunk_path(chunk), mmap_mode='r')[:rows]
+        self.last_chunk = (chunk, data)
+        return data
+
+    def __getitem__(self, key):
+        index, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(index, (int, np.integer)):
+            if not -len(self) <= index < len(self):
+                raise IndexError(f"Index {index} out of range for {len(self)} samples")
+            chunk, offset = divmod(int(index) % len(self), self.chunk_size)
+            return np.asarray(self.read_chunk(chunk)[(offset,) + rest], dtype=self.dtype)
+
+        indices = np.arange(len(self))[index]
+        order = np.argsort(indices, kind="stable")
+        sorted_indices = indices[order]
+        pieces = [np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + rest]]
+        for chunk in np.unique(sorted_indices // self.chunk_size):
+            offsets = sorted_indices[sorted_indices // self.chunk_size == chunk] - chunk * self.chunk_size
+            pieces.append(self.read_chunk(chunk)[(offsets,) + rest])
+        values = np.concatenate(pieces).astype(self.dtype, copy=False)
+        result = np.empty_like(values)
+        result[order] = values
+        return result
+
+
+class DatasetStore:
+    """
+    Self-describing directory of chunked datasets, one sub-directory of chunk files per dataset:
+        meta.json               - chunk size, configuration attributes, dtype and shape of every dataset and array
+        <dataset>/chunk_00000   - chunk_size samples as compressed .npz, or .npy that is memory-mapped on read
+        <array>.npy             - sample independent arrays, e.g. the direct field, memory-mapped on read
+    Samples are appended without rewriting earlier chunks and read lazily, see ChunkedArray.
+    Chunk and meta files are replaced atomically, a store has a single writer at a time.
+    """
+
+    def __init__(self, path, mode="a", chunk_size=100, compress=True):
+        """
+        :param path: directory of the store
+        :param mode: "r" read only, "a" open or create, "w" create, removing an existing store
+        :param chunk_size: number of samples per chunk of new datasets, an existing store keeps its own
+        :param compress: whether new datasets are compressed, uncompressed datasets are memory-mapped on read
+        """
+        if mode not in ("r", "a", "w"):
+            raise ValueError("Invalid mode value, input should be 'r', 'a' or 'w'")
+        self.path = path
+        self.mode = mode
+        self.compress = compress
+
+        if mode == "w" and os.path.isdir(path):
+            shutil.rmtree(path)
+        if os.path.exists(self.get_meta_path()):
+            with open(self.get_meta_path()) as file:
+                self.meta = json.load(file)
+        elif mode == "r":
+            raise FileNotFoundError(f"No dataset store at {path}")
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.meta = {"format": 1, "chunk_size": chunk_size, "attributes": {}, "datasets": {}, "arrays": {}}
+            self.write_meta()
+
+    def get_meta_path(self):
+        return os.path.join(self.path, "meta.json")
+
+    def write_meta(self):
+        temporary_path = self.get_meta_path() + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(self.meta, file, indent=2)
+        os.replace(temporary_path, self.get_meta_path())
+
+    def check_writable(self):
+        if self.mode == "r":
+            raise ValueError("Dataset store is opened read only")
+
+    @staticmethod
+    def to_json(value):
+        """ JSON representation of numpy values and complex numbers, used for attributes """
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, complex):
+            return [value.real, value.imag]
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    @staticmethod
+    def get_config_attributes(config=None):
+        """ Configuration the stored data was generated with, a Configuration or Config if None """
+        config = config if config is not None else Config
+        return json.loads(json.dumps({
+            "system": dict(config.system),
+            "room": dict(config.room),
+            "doi": dict(config.doi),
+            "sensors": {**{key: value for key, value in config.sensors.items() if key != "links"},
+                        "positions": config.sensors["positions"]}
+        }, default=DatasetStore.to_json))
+
+    @property
+    def attributes(self):
+        return self.meta["attributes"]
+
+    def set_attributes(self, **attributes):
+        self.check_writable()
+        self.meta["attributes"].update(json.loads(json.dumps(attributes, default=DatasetStore.to_json)))
+        self.write_meta()
+
+    def keys(self):
+        return list(self.meta["datasets"]) + list(self.meta["arrays"])
+
+    def __contains__(self, name):
+        return name in self.meta["datasets"] or name in self.meta["arrays"]
+
+    def __getitem__(self, name):
+        if name in self.meta["datasets"]:
+            return ChunkedArray(os.path.join(self.path, name), self.meta["datasets"][name], self.meta["chunk_size"])
+        if name in self.meta["arrays"]:
+            return np.load(os.path.join(self.path, name + ".npy"), mmap_mode='r')
+        raise KeyError(name)
+
+    def put(self, name, array):
+        """ Stores a sample independent array, replacing a previous one of the same name """
+        self.check_writable()
+        if name in self.meta["datasets"]:
+            raise ValueError(f"'{name}' is already a dataset of samples")
+        array = np.asarray(array)
+        path = os.path.join(self.path, name + ".npy")
+        with open(path + ".tmp", "wb") as file:
+            np.save(file, array)
+        os.replace(path + ".tmp", path)
+        self.meta["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape)}
+        self.write_meta()
+
+    def append(self, **samples):
+        """ Appends one sample to every named dataset """
+        self.extend(**{name: np.asarray(value)[None] for name, value in samples.items()})
+
+    def extend(self, **arrays):
+        """ Appends the samples along the first axis of every array to the dataset of the same name """
+        self.check_writable()
+        chunk_size = self.meta["chunk_size"]
+        for name, values in arrays.items():
+            values = np.asarray(values)
+            if name in self.meta["arrays"]:
+                raise ValueError(f"'{name}' is already a sample independent array")
+            info = self.meta["datasets"].get(name)
+            if info is None:
+                info = {"dtype": values.dtype.str, "shape": [0] + list(values.shape[1:]), "compress": self.compress}
+                os.makedirs(os.path.join(self.path, name), exist_ok=True)
+            elif list(values.shape[1:]) != info["shape"][1:]:
+                raise ValueError(f"Samples of '{name}' should have shape {tuple(info['shape'][1:])}")
+            dtype = np.dtype(info["dtype"])
+            if dtype.kind == "U" and values.dtype.kind == "U":
+                # Strings may grow, earlier chunks are cast to the wider type on read
+                dtype = np.promote_types(dtype, values.dtype)
+            values = values.astype(dtype, casting="same_kind", copy=False)
+
+            dataset = ChunkedArray(os.path.join(self.path, name), info, chunk_size)
+            length, position = info["shape"][0], 0
+            while position < len(values):
+                chunk, offset = divmod(length, chunk_size)
+                count = min(chunk_size - offset, len(values) - position)
+                block = values[position:position + count]
+                if offset:
+                    # Complete the partially filled last chunk
+                    block = np.concatenate((np.asarray(dataset.read_chunk(chunk)).astype(dtype), block))
+                dataset.last_chunk = (None, None)
+                self.write_chunk(dataset.get_chunk_path(chunk), block, info["compress"])
+                length += count
+                position += count
+            info.update({"dtype": dtype.str, "shape": [length] + info["shape"][1:]})
+            self.meta["datasets"][name] = info
+        self.write_meta()
+
+    @staticmethod
+    def write_chunk(path, block, compress):
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            if compress:
+                np.savez_compressed(file, data=block)
+            else:
+                np.save(file, block)
+        os.replace(temporary_path, path)
+
+
+if __name__ == '__main__':
+
+    store = DatasetStore("data/store_example", mode="w", chunk_size=4)
+    store.set_attributes(**DatasetStore.get_config_attributes())
+    store.extend(value=np.arange(10).reshape(5, 2))
+    store.append(value=[10, 11])
+    print(store["value"][3:6], len(store["value"]))